@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+
+from atomic_write import atomic_open
+
+
+class AnnotationCache():
+    """ On-disk cache of per-mask annotation results, for incremental rebuilds
+
+        Entries are keyed by the mask file (its content hash, or its size and
+        mtime when key_mode is "stat") plus every parameter that affects the
+        output, so a changed mask or a changed setting is simply a cache miss.
+        Entries are small json files; evict() removes the least recently used
+        ones until the cache fits in max_bytes.
+    """
+
+    # Bump when the annotation output format changes, to invalidate old entries
+    CACHE_VERSION = 2
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, key_mode='content'):
+        if key_mode not in ('content', 'stat'):
+            raise ValueError(f'key_mode must be "content" or "stat", got: {key_mode}')
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_mode = key_mode
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, mask_path, params):
+        """ Builds the cache key of a mask file and the parameters used to process it
+        """
+        digest = hashlib.sha256()
+        digest.update(f'v{self.CACHE_VERSION}'.encode())
+
+        if self.key_mode == 'content':
+            with open(mask_path, 'rb') as mask_file:
+                for chunk in iter(lambda: mask_file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        else:
+            stat = os.stat(mask_path)
+            digest.update(f'{os.path.abspath(mask_path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """ Returns the cached result, or None on a miss
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # mark the entry as recently used for eviction
+        os.utime(entry_path)
+
+        return entry
+
+    def put(self, key, result):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # concurrent workers never read a partial entry
+        with atomic_open(entry_path) as entry_file:
+            json.dump(result, entry_file)
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        total_bytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                if not f.endswith('.json'):
+                    continue
+                entry_path = os.path.join(root, f)
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_bytes += stat.st_size
+
+        evicted = 0
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(entry_path)
+            total_bytes -= size
+            evicted += 1
+
+        return evicted
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.json')
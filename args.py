@@ -20,7 +20,26 @@ class Args():
              width_to_resize = 4000,
              height_to_resize = 3000,
              generate_automatic_info = False,
-             iscrowd = 1):
+             iscrowd = 1,
+             workers = 1,
+             cache_dir = None,
+             cache_max_mb = 1024,
+             cache_key = 'content',
+             native_resolution = False,
+             instance_mode = 'files',
+             use_index = True,
+             image_format = 'PNG',
+             image_quality = 85,
+             verbose = False,
+             run_report = True,
+             progress_interval = 5.0,
+             profile_path = None,
+             unified_pipeline = False,
+             rle_format = 'uncompressed',
+             columnar_output = False,
+             use_columns = True,
+             json_backend = 'json',
+             json_precision = None):
         # stage = train, test, val
         self.stage = stage
         self.database_name = database_name
@@ -36,6 +55,25 @@ class Args():
         self.height_to_resize = height_to_resize
         self.generate_automatic_info = generate_automatic_info
         self.iscrowd = iscrowd
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.cache_max_mb = cache_max_mb
+        self.cache_key = cache_key
+        self.native_resolution = native_resolution
+        self.instance_mode = instance_mode
+        self.use_index = use_index
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.verbose = verbose
+        self.run_report = run_report
+        self.progress_interval = progress_interval
+        self.profile_path = profile_path
+        self.unified_pipeline = unified_pipeline
+        self.rle_format = rle_format
+        self.columnar_output = columnar_output
+        self.use_columns = use_columns
+        self.json_backend = json_backend
+        self.json_precision = json_precision
 
         self.base_path = f'../{self.database_name}/{self.stage}/'
         self.annotation_path = f'../{self.database_name}/{self.stage}_coco_instances.json'
@@ -59,4 +97,23 @@ class Args():
         print(f'width: {self.width}')
         print(f'height: {self.height}')
         print(f'iscrowd: {self.iscrowd}')
+        print(f'workers: {self.workers}')
+        print(f'cache_dir: {self.cache_dir}')
+        print(f'cache_max_mb: {self.cache_max_mb}')
+        print(f'cache_key: {self.cache_key}')
+        print(f'native_resolution: {self.native_resolution}')
+        print(f'instance_mode: {self.instance_mode}')
+        print(f'use_index: {self.use_index}')
+        print(f'image_format: {self.image_format}')
+        print(f'image_quality: {self.image_quality}')
+        print(f'verbose: {self.verbose}')
+        print(f'run_report: {self.run_report}')
+        print(f'progress_interval: {self.progress_interval}')
+        print(f'profile_path: {self.profile_path}')
+        print(f'unified_pipeline: {self.unified_pipeline}')
+        print(f'rle_format: {self.rle_format}')
+        print(f'columnar_output: {self.columnar_output}')
+        print(f'use_columns: {self.use_columns}')
+        print(f'json_backend: {self.json_backend}')
+        print(f'json_precision: {self.json_precision}')
 
@@ -0,0 +1,41 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_path(path):
+    """ Yields a temporary path next to path. When the block succeeds, what was
+        written there (a file or a directory) is renamed over path, so readers and
+        concurrent workers never see it half written. On an error it is removed.
+    """
+    path = str(path)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    _remove(temp_path)
+
+    try:
+        yield temp_path
+    except BaseException:
+        _remove(temp_path)
+        raise
+
+    # os.replace only renames a directory over an empty one
+    if os.path.isdir(temp_path) and os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(temp_path, path)
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """ open() for writing through atomic_path
+    """
+    with atomic_path(path) as temp_path:
+        with open(temp_path, mode) as output_file:
+            yield output_file
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
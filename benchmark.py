@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import platform
+import tempfile
+import timeit
+from itertools import groupby
+
+import numpy as np
+from PIL import Image, ImageDraw
+from pycocotools import mask
+
+from args import Args
+from coco_dataset import CocoDataset
+from coco_json_utils import AnnotationJsonUtils
+from coco_json_writer import CocoJsonWriter
+from coco_rle import compress_rle, decode_counts, decompress_rle
+from pycococreatortools import PyCocoCreatorTools
+
+
+class PyCocoCreatorBenchmark():
+    """ Times each stage of the annotation pipelines on synthetic data, and the
+        PyCocoCreatorTools hot paths against their previous implementations
+    """
+
+    def binary_mask_to_rle_groupby(self, binary_mask):
+        """ The original per-pixel RLE encoder, kept as the reference implementation
+        """
+        rle = {'counts': [], 'size': list(binary_mask.shape)}
+        counts = rle.get('counts')
+        for i, (value, elements) in enumerate(groupby(binary_mask.ravel(order='F'))):
+            if i == 0 and value == 1:
+                counts.append(0)
+            counts.append(len(list(elements)))
+
+        return rle
+
+    def create_mask(self, width, height, instances=8, seed=0):
+        """ Creates a binary mask with a few random filled ellipses
+        """
+        rng = np.random.default_rng(seed)
+        rows, cols = np.ogrid[:height, :width]
+        binary_mask = np.zeros((height, width), dtype=np.uint8)
+
+        for _ in range(instances):
+            cy, cx = rng.integers(0, height), rng.integers(0, width)
+            ry = rng.integers(1, max(2, height // 6))
+            rx = rng.integers(1, max(2, width // 6))
+            inside = ((rows - cy) / ry) ** 2 + ((cols - cx) / rx) ** 2 <= 1
+            binary_mask[inside] = 1
+
+        return binary_mask
+
+    def time_it(self, func, repeat):
+        return min(timeit.repeat(func, number=1, repeat=repeat))
+
+    def rle(self, width, height, repeat=3):
+        """ Compares binary_mask_to_rle with the groupby reference on a width x height mask
+        """
+        tools = PyCocoCreatorTools()
+        binary_mask = self.create_mask(width, height)
+
+        expected = self.binary_mask_to_rle_groupby(binary_mask)
+        result = tools.binary_mask_to_rle(binary_mask)
+        if result != expected:
+            raise AssertionError('binary_mask_to_rle output differs from the groupby reference')
+
+        reference_time = self.time_it(
+            lambda: self.binary_mask_to_rle_groupby(binary_mask), repeat)
+        current_time = self.time_it(
+            lambda: tools.binary_mask_to_rle(binary_mask), repeat)
+
+        print(f'rle {width}x{height}: groupby {reference_time:.4f}s - '
+              f'numpy {current_time:.4f}s - speedup {reference_time / current_time:.1f}x')
+
+        return reference_time, current_time
+
+    def native_resolution(self, width, height, factor=4, repeat=3):
+        """ Compares create_annotation_info on a mask factor times smaller than the image,
+            resizing the mask first (default) against contouring it at native resolution.
+            The native polygons are also compared with the contours of an exact (pixel
+            repeating) upsample of the mask
+        """
+        tools = PyCocoCreatorTools()
+        binary_mask = self.create_mask(width // factor, height // factor)
+        image_size = (width, height)
+        category_info = {'id': 1, 'is_crowd': 0}
+
+        def create(native_resolution):
+            return tools.create_annotation_info(
+                1, 1, category_info, binary_mask, image_size, native_resolution=native_resolution)
+
+        resized = create(False)
+        native = create(True)
+        upsampled_mask = np.repeat(np.repeat(binary_mask, factor, axis=0), factor, axis=1)
+        exact = tools.create_annotation_info(1, 1, category_info, upsampled_mask, image_size)
+
+        # rasterize the polygon sets at image size to compare the shapes they cover
+        resized_rle = mask.merge(mask.frPyObjects(resized['segmentation'], height, width))
+        native_rle = mask.merge(mask.frPyObjects(native['segmentation'], height, width))
+        exact_rle = mask.merge(mask.frPyObjects(exact['segmentation'], height, width))
+        iou = mask.iou([native_rle], [resized_rle], [0])[0][0]
+        exact_iou = mask.iou([native_rle], [exact_rle], [0])[0][0]
+        area_error = abs(native['area'] - resized['area']) / resized['area']
+        bbox_error = np.max(np.abs(np.subtract(native['bbox'], resized['bbox'])))
+
+        resize_time = self.time_it(lambda: create(False), repeat)
+        native_time = self.time_it(lambda: create(True), repeat)
+
+        print(f'native_resolution {width // factor}x{height // factor} -> {width}x{height}: '
+              f'resize {resize_time:.4f}s - native {native_time:.4f}s - '
+              f'speedup {resize_time / native_time:.1f}x - polygon IoU {iou:.4f} '
+              f'(exact upsample {exact_iou:.4f}) - area error {area_error:.2%} - bbox error {bbox_error:.2f}px')
+
+        return resize_time, native_time, iou, exact_iou, area_error, bbox_error
+
+    def mask_statistics(self, width, height, repeat=3):
+        """ Validates PyCocoCreatorTools.mask_statistics against pycocotools encode/area/toBbox
+            plus the separate RLE pass it replaces, and times both
+        """
+        tools = PyCocoCreatorTools()
+        binary_mask = self.create_mask(width, height)
+
+        def separate():
+            encoded = mask.encode(np.asfortranarray(binary_mask.astype(np.uint8)))
+            return tools.binary_mask_to_rle(binary_mask), mask.area(encoded), mask.toBbox(encoded)
+
+        rle, area, bbox = tools.mask_statistics(binary_mask)
+        expected_rle, expected_area, expected_bbox = separate()
+        encoded_rle = mask.frPyObjects(rle, height, width)
+        if (rle != expected_rle or area != expected_area or not np.array_equal(bbox, expected_bbox)
+                or mask.decode(encoded_rle).tobytes() != binary_mask.tobytes()):
+            raise AssertionError('mask_statistics output differs from pycocotools')
+
+        separate_time = self.time_it(separate, repeat)
+        fused_time = self.time_it(lambda: tools.mask_statistics(binary_mask), repeat)
+
+        print(f'mask_statistics {width}x{height}: encode/area/toBbox/rle {separate_time:.4f}s - '
+              f'fused {fused_time:.4f}s - speedup {separate_time / fused_time:.1f}x')
+
+        return separate_time, fused_time
+
+    def compressed_rle(self, width, height, repeat=3):
+        """ Validates compress_rle and decode_counts against the compressed RLE of
+            pycocotools encode/frPyObjects, and times them
+        """
+        tools = PyCocoCreatorTools()
+        binary_mask = self.create_mask(width, height)
+        rle = tools.binary_mask_to_rle(binary_mask)
+
+        def reference():
+            return mask.frPyObjects(rle, height, width)
+
+        compressed = compress_rle(rle)
+        expected = mask.encode(np.asfortranarray(binary_mask.astype(np.uint8)))
+        expected_counts = expected['counts'].decode('ascii')
+        if (compressed['counts'] != expected_counts or compressed['size'] != list(expected['size'])
+                or reference()['counts'].decode('ascii') != expected_counts
+                or decode_counts(expected_counts).tolist() != rle['counts']
+                or decompress_rle(compressed) != rle
+                or mask.decode(compressed).tobytes() != binary_mask.tobytes()):
+            raise AssertionError('compress_rle/decode_counts output differs from pycocotools')
+
+        reference_time = self.time_it(reference, repeat)
+        compress_time = self.time_it(lambda: compress_rle(rle), repeat)
+        decode_time = self.time_it(lambda: decode_counts(expected_counts), repeat)
+
+        print(f'compressed_rle {width}x{height}: frPyObjects {reference_time:.4f}s - '
+              f'compress_rle {compress_time:.4f}s - decode_counts {decode_time:.4f}s')
+
+        return reference_time, compress_time, decode_time
+
+    def suite(self, args):
+        """ Times every stage of the pipelines on a synthetic dataset and returns the results
+        """
+        shapes = SyntheticShapes(args.width, args.height, instances=args.instances, colors=args.colors,
+                                 complexity=args.complexity, mask_scale=args.mask_scale, seed=args.seed)
+        samples = [shapes.create_sample(image_id) for image_id in range(1, args.images + 1)]
+        image_size = (args.width, args.height)
+        pixels = args.width * args.height * args.images
+
+        tools = PyCocoCreatorTools()
+        aju = AnnotationJsonUtils()
+        aju.args = args
+        aju.verbose = False
+
+        stages = dict()
+
+        def record(name, func, items, item_pixels=pixels):
+            seconds = self.time_it(func, args.repeat)
+            stages[name] = {
+                'seconds': seconds,
+                'items': items,
+                'items_per_second': items / seconds if seconds > 0 else None,
+                'pixels_per_second': item_pixels / seconds if seconds > 0 else None,
+            }
+            print(f'{name}: {seconds:.4f}s - {items} items')
+
+        instance_masks = [instance_mask for sample in samples for _, instance_mask in sample['instance_masks']]
+        resized_masks = [tools.resize_binary_mask(instance_mask, image_size) for instance_mask in instance_masks]
+
+        def isolate():
+            for sample in samples:
+                aju.mask_image = sample['color_mask']
+                aju.width, aju.height = sample['color_mask'].size
+                aju._isolate_masks()
+
+        def create_annotations():
+            annotations = []
+            for sample in samples:
+                aju.image_id = sample['image_id']
+                aju.category_ids = sample['category_ids']
+                aju.iscrowd = 0
+                aju.mask_image = sample['color_mask']
+                aju.width, aju.height = sample['color_mask'].size
+                aju._isolate_masks()
+                aju._create_annotations()
+                annotations += aju.annotations
+            return annotations
+
+        record('isolate', isolate, len(samples))
+        record('resize', lambda: [tools.resize_binary_mask(m, image_size) for m in instance_masks],
+               len(instance_masks), sum(m.size for m in resized_masks))
+        record('rle', lambda: [tools.mask_statistics(m) for m in resized_masks],
+               len(resized_masks), sum(m.size for m in resized_masks))
+        record('contour_simplify', lambda: [tools.binary_mask_to_polygon(m, 2) for m in resized_masks],
+               len(resized_masks), sum(m.size for m in resized_masks))
+        record('isolate_contour_simplify', create_annotations, len(samples))
+
+        annotations = create_annotations()
+        images = [{'id': sample['image_id'], 'file_name': f'{sample["image_id"]}.png', 'license': 0,
+                   'width': args.width, 'height': args.height} for sample in samples]
+        categories = [{'supercategory': 'shape', 'id': category_id, 'name': f'color_{category_id}'}
+                      for category_id in range(1, args.colors + 1)]
+
+        with tempfile.TemporaryDirectory() as dataset_dir:
+            shapes.write(dataset_dir, samples)
+            json_path = os.path.join(dataset_dir, 'benchmark.json')
+
+            def write_json():
+                coco_output = {'info': {}, 'licenses': [], 'images': [], 'annotations': [], 'categories': categories}
+                with CocoJsonWriter(json_path, coco_output) as writer:
+                    for image in images:
+                        writer.write('images', image)
+                    writer.write_items('annotations', annotations)
+
+            record('json', write_json, len(annotations))
+
+            dataset = CocoDataset()
+            dataset.main(self.create_dataset_args(dataset_dir, args))
+
+            def render_html():
+                return [dataset.save_image_to_html(image_id=image['id'], max_width=args.max_width)
+                        for image in images]
+
+            record('html', render_html, len(images))
+
+        return {
+            'meta': {
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(' '),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'params': {key: getattr(args, key) for key in (
+                    'width', 'height', 'images', 'instances', 'colors', 'complexity',
+                    'mask_scale', 'seed', 'repeat', 'max_width')},
+            },
+            'stages': stages,
+        }
+
+    def create_dataset_args(self, dataset_dir, args):
+        dataset_args = Args()
+        dataset_args.base_path = dataset_dir
+        dataset_args.stage = 'benchmark'
+        dataset_args.max_width = args.max_width
+        dataset_args.use_index = False
+        return dataset_args
+
+    def save_results(self, results, output_path):
+        with open(output_path, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+
+        print(f'Benchmark - results saved at: {output_path}')
+
+    def compare_results(self, results, baseline_path):
+        """ Prints each stage's time against a previously saved results file
+        """
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if baseline['meta']['params'] != results['meta']['params']:
+            print('WARNING: the baseline was measured with different parameters')
+
+        for name, stage in results['stages'].items():
+            if name not in baseline['stages']:
+                continue
+            baseline_seconds = baseline['stages'][name]['seconds']
+            ratio = stage['seconds'] / baseline_seconds if baseline_seconds > 0 else float('inf')
+            print(f'{name}: {baseline_seconds:.4f}s -> {stage["seconds"]:.4f}s ({ratio:.2f}x)')
+
+    def main(self, args):
+        if args.implementations:
+            self.rle(args.width, args.height, args.repeat)
+            self.native_resolution(args.width, args.height, repeat=args.repeat)
+            self.mask_statistics(args.width, args.height, args.repeat)
+            self.compressed_rle(args.width, args.height, args.repeat)
+
+        results = self.suite(args)
+        self.save_results(results, args.output)
+
+        if args.baseline:
+            self.compare_results(results, args.baseline)
+
+
+class SyntheticShapes():
+    """ Generates a synthetic dataset in the style of datasets/shapes
+
+        Every sample has an RGB image, one binary mask per instance (named like
+        1001_circle_0.png) and one color mask where instance i is painted in color
+        i % colors. complexity is the number of vertices of each random shape.
+    """
+    SHAPES = ['circle', 'square', 'triangle', 'polygon']
+
+    def __init__(self, width, height, instances=4, colors=4, complexity=16, mask_scale=1.0, seed=0):
+        self.width = width
+        self.height = height
+        self.instances = instances
+        self.colors = colors
+        self.complexity = complexity
+        self.mask_scale = mask_scale
+        self.seed = seed
+
+        self.palette = [(int(60 + 180 * i / max(1, colors - 1)), int(255 - 180 * i / max(1, colors - 1)), 100)
+                        for i in range(colors)]
+
+    def create_sample(self, image_id):
+        rng = np.random.default_rng((self.seed, image_id))
+        mask_size = (max(1, int(self.width * self.mask_scale)), max(1, int(self.height * self.mask_scale)))
+
+        image = Image.fromarray(rng.integers(0, 255, (self.height, self.width, 3), dtype=np.uint8))
+        color_mask = Image.new('RGB', mask_size)
+        color_draw = ImageDraw.Draw(color_mask)
+
+        instance_masks = []
+        for i in range(self.instances):
+            shape = self.SHAPES[rng.integers(len(self.SHAPES))]
+            points = self.create_shape_points(rng, mask_size)
+
+            instance_mask = Image.new('1', mask_size)
+            ImageDraw.Draw(instance_mask).polygon(points, fill=1)
+            instance_masks.append((shape, np.asarray(instance_mask)))
+
+            color_draw.polygon(points, fill=self.palette[i % self.colors])
+
+        category_ids = {str(color): category_id for category_id, color in enumerate(self.palette, start=1)}
+
+        return {
+            'image_id': image_id,
+            'image': image,
+            'instance_masks': instance_masks,
+            'color_mask': color_mask,
+            'category_ids': category_ids,
+        }
+
+    def create_shape_points(self, rng, mask_size):
+        # A star-shaped polygon, its radius jitters more as complexity grows
+        width, height = mask_size
+        center = rng.uniform(0.2, 0.8) * width, rng.uniform(0.2, 0.8) * height
+        radius = rng.uniform(0.05, 0.2) * min(width, height)
+
+        vertices = max(3, self.complexity)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, vertices))
+        jitter = min(0.6, 0.02 * vertices)
+        radii = radius * rng.uniform(1 - jitter, 1 + jitter, vertices)
+
+        xs = center[0] + radii * np.cos(angles)
+        ys = center[1] + radii * np.sin(angles)
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    def write(self, base_path, samples):
+        """ Writes images/, annotations/ (the color masks, named like the images) and
+            instances/ (one binary mask per instance)
+        """
+        for folder in ('images', 'annotations', 'instances'):
+            os.makedirs(os.path.join(base_path, folder), exist_ok=True)
+
+        for sample in samples:
+            image_id = sample['image_id']
+            sample['image'].save(os.path.join(base_path, 'images', f'{image_id}.png'))
+            sample['color_mask'].save(os.path.join(base_path, 'annotations', f'{image_id}.png'))
+            for i, (shape, instance_mask) in enumerate(sample['instance_masks']):
+                Image.fromarray(instance_mask).save(
+                    os.path.join(base_path, 'instances', f'{image_id}_{shape}_{i}.png'))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark")
+
+    parser.add_argument("-rw", "--width", dest="width", default=4000, type=int,
+                        help="width of the synthetic images")
+
+    parser.add_argument("-rh", "--height", dest="height", default=3000, type=int,
+                        help="height of the synthetic images")
+
+    parser.add_argument("-n", "--images", dest="images", default=2, type=int,
+                        help="number of synthetic images")
+
+    parser.add_argument("-in", "--instances", dest="instances", default=8, type=int,
+                        help="number of instances per image")
+
+    parser.add_argument("-co", "--colors", dest="colors", default=4, type=int,
+                        help="number of distinct mask colors (categories)")
+
+    parser.add_argument("-cx", "--complexity", dest="complexity", default=16, type=int,
+                        help="number of vertices of each synthetic shape")
+
+    parser.add_argument("-ms", "--mask_scale", dest="mask_scale", default=1.0, type=float,
+                        help="mask resolution relative to the image, masks are resized to the image size")
+
+    parser.add_argument("-s", "--seed", dest="seed", default=0, type=int,
+                        help="seed of the synthetic dataset")
+
+    parser.add_argument("-r", "--repeat", dest="repeat", default=3, type=int,
+                        help="number of timed repetitions, the best one is reported")
+
+    parser.add_argument("-mw", "--max_width", dest="max_width", default=920, type=int,
+                        help="max width of the rendered HTML images")
+
+    parser.add_argument("-o", "--output", dest="output", default="benchmark_results.json",
+                        help="path of the json results file")
+
+    parser.add_argument("-bl", "--baseline", dest="baseline", default=None,
+                        help="previous results file to compare against")
+
+    parser.add_argument("-im", "--implementations", dest="implementations", default=0, type=int,
+                        help="also compare the optimized tools against their previous implementations: 0 or 1")
+
+    args = parser.parse_args()
+
+    benchmark = PyCocoCreatorBenchmark()
+    benchmark.main(args)
@@ -0,0 +1,305 @@
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from atomic_write import atomic_path
+from coco_index import LazyJsonMapping
+from coco_rle import decode_counts
+
+
+class CocoColumnsWriter():
+    """ Writes a COCO dataset as a directory of flat columns, for loaders that
+        memory-map it instead of parsing json
+
+        Annotations become fixed-width arrays (id, image_id, category_id, iscrowd,
+        area, bbox) and variable-length buffers with offset arrays: polygons are
+        float32 [x1, y1, x2, y2, ...] runs in one coordinates buffer, RLE counts
+        (compressed ones are expanded) runs in one counts buffer. Images, which
+        vary in their fields, are kept as json objects in one byte buffer, and the
+        small sections (info, licenses, categories) in meta.json.
+
+        It takes the same calls as CocoJsonWriter, and like it spools every
+        column to its own temporary file as items arrive. close() only adds the
+        .npy headers and the grouping by image, writes the directory next to
+        output_dir and moves it into place. With source_path, the json file
+        written alongside, its size and mtime are recorded so readers can tell
+        when the columns no longer match it.
+    """
+
+    COLUMNS_VERSION = 1
+
+    # dtype and row shape of every spooled column
+    COLUMNS = {
+        'image_ids': (np.int64, ()),
+        'image_ranges': (np.int64, (2,)),
+        'annotation_ids': (np.int64, ()),
+        'annotation_image_ids': (np.int64, ()),
+        'category_ids': (np.int64, ()),
+        'iscrowd': (np.uint8, ()),
+        'area': (np.float64, ()),
+        'bbox': (np.float64, (4,)),
+        'polygon_bounds': (np.int64, ()),
+        'polygon_offsets': (np.int64, ()),
+        'coordinates': (np.float32, ()),
+        'rle_bounds': (np.int64, ()),
+        'rle_sizes': (np.int64, (2,)),
+        'rle_counts': (np.uint32, ()),
+    }
+
+    def __init__(self, output_dir, coco_output, streams=('images', 'annotations'), source_path=None):
+        self.output_dir = str(output_dir)
+        self.coco_output = coco_output
+        self.streams = list(streams)
+        self.source_path = source_path
+
+        self.spools = {name: tempfile.TemporaryFile() for name in self.COLUMNS}
+        self.images_spool = tempfile.TemporaryFile()
+
+        # running totals, the bounds columns hold them after every item
+        self.image_bytes = 0
+        self.polygons = 0
+        self.coordinates = 0
+        self.rle_counts = 0
+        for name in ('polygon_bounds', 'polygon_offsets', 'rle_bounds'):
+            self._append(name, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, stream, item):
+        if stream == 'images':
+            image_json = json.dumps(item).encode()
+            self.images_spool.write(image_json)
+            self._append('image_ids', item['id'])
+            self._append('image_ranges', (self.image_bytes, self.image_bytes + len(image_json)))
+            self.image_bytes += len(image_json)
+        elif stream == 'annotations':
+            self._write_annotation(item)
+        else:
+            raise KeyError(f'CocoColumnsWriter can not stream "{stream}"')
+
+    def write_items(self, stream, items):
+        for item in items:
+            self.write(stream, item)
+
+    def _write_annotation(self, annotation):
+        self._append('annotation_ids', annotation['id'])
+        self._append('annotation_image_ids', annotation['image_id'])
+        self._append('category_ids', annotation['category_id'])
+        self._append('iscrowd', annotation['iscrowd'])
+        self._append('area', annotation['area'])
+        self._append('bbox', annotation['bbox'])
+
+        segmentation = annotation['segmentation']
+        if isinstance(segmentation, dict):
+            counts = segmentation['counts']
+            if isinstance(counts, (str, bytes)):
+                counts = decode_counts(counts)
+            counts = np.asarray(counts, dtype=np.int64)
+            if counts.size and counts.max() > np.iinfo(np.uint32).max:
+                raise ValueError('RLE counts do not fit in uint32')
+
+            self._append('rle_counts', counts)
+            self._append('rle_sizes', segmentation['size'])
+            self.rle_counts += counts.size
+        else:
+            for polygon in segmentation:
+                polygon = np.asarray(polygon, dtype=np.float32)
+                self._append('coordinates', polygon)
+                self.coordinates += polygon.size
+                self._append('polygon_offsets', self.coordinates)
+            self._append('rle_sizes', (0, 0))
+            self.polygons += len(segmentation)
+
+        self._append('polygon_bounds', self.polygons)
+        self._append('rle_bounds', self.rle_counts)
+
+    def _append(self, name, values):
+        self.spools[name].write(np.asarray(values, dtype=self.COLUMNS[name][0]).tobytes())
+
+    def close(self):
+        with atomic_path(self.output_dir) as temp_dir:
+            os.makedirs(temp_dir)
+            self._write_columns(temp_dir)
+
+        self.discard()
+
+    def _write_columns(self, temp_dir):
+        self.images_spool.seek(0)
+        with open(os.path.join(temp_dir, 'images.json'), 'wb') as images_file:
+            shutil.copyfileobj(self.images_spool, images_file)
+
+        # images keep the first of any duplicate id, like CocoDataset does
+        image_ids = self._read('image_ids')
+        first_images = np.sort(np.unique(image_ids, return_index=True)[1])
+
+        # group annotations by image, keeping the write order inside each group
+        annotation_image_ids = self._read('annotation_image_ids')
+        order = np.argsort(annotation_image_ids, kind='stable')
+        segmentation_image_ids, group_starts = np.unique(annotation_image_ids[order], return_index=True)
+        group_ends = np.append(group_starts[1:], len(order)) if group_starts.size else group_starts
+
+        columns = {
+            'image_ids': image_ids[first_images],
+            'image_ranges': self._read('image_ranges')[first_images],
+            'segmentation_image_ids': segmentation_image_ids.astype(np.int64),
+            'segmentation_bounds': np.stack((group_starts, group_ends), axis=1).astype(np.int64),
+            'annotation_order': order.astype(np.int64),
+        }
+        for name, column in columns.items():
+            np.save(os.path.join(temp_dir, f'{name}.npy'), column)
+
+        # the other columns are copied from their spools as they are
+        for name in self.COLUMNS:
+            if name not in columns:
+                self._save_spool(temp_dir, name)
+
+        meta = {
+            'version': self.COLUMNS_VERSION,
+            'sections': {key: value for key, value in self.coco_output.items() if key not in self.streams},
+        }
+        if self.source_path is not None:
+            stat = os.stat(self.source_path)
+            meta['source_size'] = stat.st_size
+            meta['source_mtime_ns'] = stat.st_mtime_ns
+        with open(os.path.join(temp_dir, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def _read(self, name):
+        dtype, shape = self.COLUMNS[name]
+        spool = self.spools[name]
+        spool.seek(0)
+        return np.frombuffer(spool.read(), dtype=dtype).reshape((-1,) + shape)
+
+    def _save_spool(self, temp_dir, name):
+        dtype, shape = self.COLUMNS[name]
+        spool = self.spools[name]
+        rows = spool.seek(0, os.SEEK_END) // (np.dtype(dtype).itemsize * int(np.prod(shape)))
+
+        with open(os.path.join(temp_dir, f'{name}.npy'), 'wb') as column_file:
+            np.lib.format.write_array_header_1_0(column_file, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                'fortran_order': False,
+                'shape': (rows,) + shape,
+            })
+            spool.seek(0)
+            shutil.copyfileobj(spool, column_file)
+
+    def discard(self):
+        for spool in self.spools.values():
+            spool.close()
+        self.images_spool.close()
+
+
+class ColumnarAnnotations(LazyJsonMapping):
+    """ The annotations of every image, built on access from memory-mapped columns
+
+        Works like the grouped LazyJsonMapping of CocoIndex, with the annotation
+        row numbers in place of byte ranges. Polygons and RLE counts are numpy
+        views of the mapped buffers, nothing is parsed or copied.
+    """
+
+    def __init__(self, columns, keys, rows, group_bounds):
+        super().__init__(columns, keys, rows, group_bounds)
+        self.columns = columns
+
+    def _load(self, row, _):
+        columns = self.columns
+
+        annotation = {
+            'id': columns['annotation_ids'][row].item(),
+            'image_id': columns['annotation_image_ids'][row].item(),
+            'category_id': columns['category_ids'][row].item(),
+            'iscrowd': columns['iscrowd'][row].item(),
+            'area': columns['area'][row].item(),
+            'bbox': columns['bbox'][row],
+        }
+
+        if annotation['iscrowd'] == 1:
+            start, end = columns['rle_bounds'][row:row + 2]
+            annotation['segmentation'] = {
+                'counts': columns['rle_counts'][start:end],
+                'size': columns['rle_sizes'][row].tolist(),
+            }
+        else:
+            first, last = columns['polygon_bounds'][row:row + 2]
+            offsets = columns['polygon_offsets'][first:last + 1]
+            annotation['segmentation'] = [columns['coordinates'][start:end]
+                                          for start, end in zip(offsets[:-1], offsets[1:])]
+
+        return annotation
+
+
+class CocoColumns():
+    """ Opens a directory written by CocoColumnsWriter, with the same interface as
+        CocoIndex: images and segmentations mappings, and load_sections()
+    """
+
+    def __init__(self, columns_dir):
+        self.columns_dir = str(columns_dir)
+
+    def load(self):
+        with open(os.path.join(self.columns_dir, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+
+        if self.meta.get('version') != CocoColumnsWriter.COLUMNS_VERSION:
+            raise ValueError(f'unsupported columns version in {self.columns_dir}: {self.meta.get("version")}')
+
+        self.columns = dict()
+        for file_name in os.listdir(self.columns_dir):
+            if file_name.endswith('.npy'):
+                self.columns[file_name[:-4]] = np.load(
+                    os.path.join(self.columns_dir, file_name), mmap_mode='r')
+
+        self.images_file = open(os.path.join(self.columns_dir, 'images.json'), 'rb')
+        if os.fstat(self.images_file.fileno()).st_size > 0:
+            self.images_source = mmap.mmap(self.images_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.images_source = b''
+
+        self.images = LazyJsonMapping(
+            self.images_source, self.columns['image_ids'], self.columns['image_ranges'])
+
+        order = self.columns['annotation_order']
+        self.segmentations = ColumnarAnnotations(
+            self.columns, self.columns['segmentation_image_ids'], np.stack((order, order + 1), axis=1),
+            self.columns['segmentation_bounds'])
+
+        return self
+
+    def close(self):
+        if isinstance(self.images_source, mmap.mmap):
+            self.images_source.close()
+        self.images_file.close()
+
+    def load_sections(self, names):
+        return {name: section for name, section in self.meta['sections'].items() if name in names}
+
+    def is_valid(self, json_path):
+        """ Whether the columns were written along with json_path as it is now, like
+            CocoIndex.is_valid. Columns regenerated without their json are taken as they are
+        """
+        try:
+            with open(os.path.join(self.columns_dir, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return False
+
+        if meta.get('version') != CocoColumnsWriter.COLUMNS_VERSION:
+            return False
+        if not os.path.exists(json_path):
+            return True
+
+        stat = os.stat(json_path)
+        return (meta.get('source_size') == stat.st_size and
+                meta.get('source_mtime_ns') == stat.st_mtime_ns)
@@ -1,37 +1,78 @@
-import json
 import glob
 from pathlib import Path
 from PIL import Image as PILImage
+from PIL import ImageColor
 import numpy as np
-from math import trunc
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO
 import os
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from atomic_write import atomic_open
+from coco_columns import CocoColumns
+from coco_index import CocoIndex
+from json_serializer import JsonSerializer
+from coco_rle import decode_counts
 
 import IPython
 
 
+# The dataset opened by each HTML report worker process, see CocoDataset.save_images_to_html
+report_dataset = None
+
+
+def init_report_worker(args):
+    global report_dataset
+    report_dataset = CocoDataset()
+    report_dataset.main(args)
+
+
+def save_page_task(task):
+    return report_dataset.save_page_to_html(*task)
+
+
 class CocoDataset():
     def main(self, args):
 
+        self.args = args
+        self.workers = args.workers
         self.base_path = args.base_path 
         self.annotation_path = os.path.join(self.base_path, args.stage + '.json')
+        self.columns_path = os.path.join(self.base_path, args.stage + '.columns')
         self.image_dir = os.path.join(self.base_path, args.images_path)
         self.mask_dir = os.path.join(self.base_path, args.masks_path) 
         self.max_width = args.max_width
         self.image_id = args.image_id 
+        self.image_format = args.image_format
+        self.image_quality = args.image_quality
+        self.serializer = JsonSerializer(args.json_backend)
 
         # Customize these segmentation colors if you like, if there are more segmentations
         # than colors in an image, the remaining segmentations will default to white
         self.colors = ['red', 'green', 'blue', 'yellow']
 
-        if(not os.path.exists(self.annotation_path)): 
+        use_columns = args.use_columns and os.path.isdir(self.columns_path)
+        if(use_columns and not CocoColumns(self.columns_path).is_valid(self.annotation_path)):
+            # the json was regenerated without the columns, they describe an older run
+            print(f'WARNING: {self.columns_path} does not match {self.annotation_path}, reading the json instead')
+            use_columns = False
+
+        if(not use_columns and not os.path.exists(self.annotation_path)): 
             raise Exception(f'File not found {self.annotation_path}, please generate before run.')
-        
-        with open(self.annotation_path) as json_file:
-            self.coco = json.load(json_file)
-            json_file.close() 
+
+        self.index = None
+        if(use_columns):
+            # images and segmentations are served from memory-mapped columns, nothing is parsed up front
+            self.index = CocoColumns(self.columns_path).load()
+            self.coco = self.index.load_sections(['info', 'licenses', 'categories'])
+        elif(args.use_index):
+            # images and segmentations are parsed per image, on access, from the sidecar index
+            self.index = CocoIndex(self.annotation_path, loads=self.serializer.loads).load()
+            self.coco = self.index.load_sections(['info', 'licenses', 'categories'])
+        else:
+            with open(self.annotation_path) as json_file:
+                self.coco = self.serializer.load(json_file)
+                json_file.close() 
 
         self._process_info()
         self._process_licenses()
@@ -77,6 +118,11 @@ class CocoDataset():
             raise Exception(
                 f'sorry, there is not segmentations for image_id...')
 
+        if(self.index is not None):
+            self.images = self.index.images
+            self.annotations = self.index.images
+            return
+
         self.images = dict()
         self.annotations = dict()
 
@@ -90,6 +136,10 @@ class CocoDataset():
 
 
     def _process_segmentations(self):
+        if(self.index is not None):
+            self.segmentations = self.index.segmentations
+            return
+
         self.segmentations = dict()
         for segmentation in self.coco['annotations']:
             image_id = segmentation['image_id']
@@ -119,16 +169,41 @@ class CocoDataset():
                 print(f'    id {cat_id}: {self.categories[cat_id]["name"]}')
 
     def load_image(self, img_dir, image):
-        # Open the image
+        # Open the image, only its header is read here, the returned image keeps the original size
         image_path = Path(img_dir) / image['file_name']
         image = PILImage.open(image_path)
 
+        # Downscale to the display width before encoding, from a second handle
+        # since decoding in draft mode changes the reported size
+        image_format = self.image_format.upper()
         buffer = BytesIO()
-        image.save(buffer, format='PNG')
+
+        with PILImage.open(image_path) as display_source:
+            display_image = self.create_display_image(display_source)
+
+            if image_format == 'JPEG' and display_image.mode not in ('RGB', 'L'):
+                display_image = display_image.convert('RGB')
+
+            if image_format == 'PNG':
+                display_image.save(buffer, format=image_format)
+            else:
+                display_image.save(buffer, format=image_format, quality=self.image_quality)
         buffer.seek(0)
 
         data_uri = base64.b64encode(buffer.read()).decode('ascii')
-        return image, "data:image/png;base64,{0}".format(data_uri)
+        return image, "data:image/{0};base64,{1}".format(image_format.lower(), data_uri)
+
+    def create_display_image(self, image):
+        adjusted_width, _, adjusted_height = self.resize_image(image)
+        display_size = (int(adjusted_width), max(1, round(adjusted_height)))
+
+        if display_size == image.size:
+            return image
+
+        # Let the decoder scale down while decoding when the format supports it (JPEG)
+        image.draft(image.mode, display_size)
+
+        return image.resize(display_size, PILImage.BILINEAR, reducing_gap=3.0)
 
     def resize_image(self, image):
         max_width = self.max_width
@@ -139,45 +214,64 @@ class CocoDataset():
 
         return adjusted_width, adjusted_ratio, adjusted_height
 
-    def save_images_to_html(self, images_ids, max_width=880, show_bbox=True, show_polys=True, show_crowds=True, show_mask_image=True, page_items_size=4):
-
-        html = None
+    def save_images_to_html(self, images_ids, max_width=880, show_bbox=True, show_polys=True, show_crowds=True, show_mask_image=True, page_items_size=4, output_dir='results'):
 
         print('Images') 
 
         data = datetime.datetime.now().strftime("%Y.%m.%d_%H%M%S")
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Split the images into pages, the last one takes whatever remains
+        images_ids = list(images_ids)
+        pages = [images_ids[i:i + page_items_size] for i in range(0, len(images_ids), page_items_size)]
+
+        tasks = []
+        for page_images_ids in pages:
+            page_path = os.path.join(output_dir, f'{data}_{page_images_ids[0]}.html')
+            tasks.append((page_path, page_images_ids, max_width, show_bbox, show_polys, show_crowds, show_mask_image))
 
-        html_file = None
-        css = self.get_css()
-        item_in_page = 0 
+        if self.workers > 1 and len(tasks) > 1:
+            # Every worker opens the dataset once, then builds whole pages
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_report_worker, initargs=(self.args,)) as executor:
+                page_paths = list(executor.map(save_page_task, tasks))
+        else:
+            page_paths = [self.save_page_to_html(*task) for task in tasks]
+
+        index_path = os.path.join(output_dir, f'{data}_index.html')
+        self.save_index_to_html(index_path, page_paths, pages)
 
-        for i, image_id in enumerate(images_ids):
-            
-            if(not html_file):
-                html_file = open(f"results/{data}_{image_id}.html", "w")
+        print(f"\n{len(page_paths)} pages saved, index at: {index_path}\n")
+        print('==================')
 
-            html = self.save_image_to_html(
-                image_id=image_id, max_width=max_width, show_bbox=show_bbox, show_polys=show_polys, show_crowds=show_crowds, show_mask_image=show_mask_image, item_in_page=item_in_page)
-            html_file.write(html)
+        return index_path
 
-            if ((i + 1) % page_items_size == 0):
-                html_file.write(css)
-                html_file.close()
-                print(f"\nfile saved at: results/{data}_{image_id}.html - i: {i} - item_in_page: {item_in_page}\n\n")
+    def save_page_to_html(self, page_path, images_ids, max_width=880, show_bbox=True, show_polys=True, show_crowds=True, show_mask_image=True):
+        # every image writes its markup into the one page buffer
+        buffer = StringIO()
+        for item_in_page, image_id in enumerate(images_ids):
+            self.save_image_to_html(
+                image_id=image_id, max_width=max_width, show_bbox=show_bbox, show_polys=show_polys, show_crowds=show_crowds, show_mask_image=show_mask_image, item_in_page=item_in_page,
+                buffer=buffer)
+        buffer.write(self.get_css())
 
-                item_in_page = 0
-                html_file = None
+        # readers never see a half written page
+        with atomic_open(page_path) as html_file:
+            html_file.write(buffer.getvalue())
+        print(f"\nfile saved at: {page_path}\n")
 
-            item_in_page += 1
+        return page_path
 
-        if (not html and len(images_ids) % page_items_size >= 1):
-            html_file.write(html)
-            html_file.write(css)
-            html_file.close()
-            print(f"\nfile saved at: results/{data}_remains.html\n")
-            print('==================')
+    def save_index_to_html(self, index_path, page_paths, pages):
+        buffer = StringIO()
+        buffer.write('<b>Pages</b><ul>')
+        for page_path, page_images_ids in zip(page_paths, pages):
+            buffer.write(f'<li><a href="{os.path.basename(page_path)}">Images: {", ".join(str(i) for i in page_images_ids)}</a></li>')
+        buffer.write('</ul>')
 
-    def save_image_to_html(self, image_index=None, image_id=None, max_width=880, show_bbox=True, show_polys=True, show_crowds=True, show_mask_image=True, item_in_page=0):
+        with atomic_open(index_path) as html_file:
+            html_file.write(buffer.getvalue())
+
+    def save_image_to_html(self, image_index=None, image_id=None, max_width=880, show_bbox=True, show_polys=True, show_crowds=True, show_mask_image=True, item_in_page=0, buffer=None):
 
         html = ""
         print('==================')
@@ -199,13 +293,13 @@ class CocoDataset():
         # for key, val in image.items():
         #     print(f'  {key}: {val}')
 
+        if(max_width != None and max_width > 0):
+            self.max_width = max_width
+
         # Open the image
         image, image_path = self.load_image(self.image_dir, image_info)
         mask_image, mask_path = self.load_image(self.mask_dir, mask_image_info)
 
-        if(max_width != None and max_width > 0):
-            self.max_width = max_width
-
         # Calculate the size and adjusted display size
         adjusted_width, adjusted_ratio, adjusted_height = self.resize_image(
             image)
@@ -238,117 +332,110 @@ class CocoDataset():
                 if seg['iscrowd'] == 0:
                     polygons[seg['id']] = []
                     for seg_points in seg['segmentation']:
-                        seg_points = np.multiply(
-                            seg_points, adjusted_ratio).astype(int)
                         polygons[seg['id']].append(
-                            str(seg_points).lstrip('[').rstrip(']'))
+                            self.format_svg_points(seg_points, adjusted_ratio))
                 else:
-                    # Decode the RLE
-                    px = 0
-                    rle_list = [] 
-
-                    for j, counts in enumerate(seg['segmentation']['counts']):
-
-                        if counts < 0:
-                            print(f'ERROR: One of the counts was negative, treating as 0: {counts}')
-                            counts = 0
-                        
-                        if j % 2 == 0:
-                            # Empty pixels
-                            px += counts
-                        else:
-                            # Create one or more vertical rectangles
-                            x1 = trunc(px / adjusted_height)
-                            y1 = px % adjusted_height
-                            px += counts
-                            x2 = trunc(px / adjusted_height)
-                            y2 = px % adjusted_height
-                            
-                            if x2 == x1: # One vertical column
-                                line = [x1, y1, 1, (y2 - y1)]
-                                line = np.multiply(line, adjusted_ratio)
-                                rle_list.append(line)
-                            else: # Two or more columns
-                                # Insert left-most line first
-                                left_line = [x1, y1, 1, (adjusted_height - y1)]
-                                left_line = np.multiply(left_line, adjusted_ratio)
-                                rle_list.append(left_line)
-                                
-                                # Insert middle lines (if needed)
-                                lines_spanned = x2 - x1 + 1
-                                if lines_spanned > 2: # Two columns won't have a middle
-                                    middle_lines = [(x1 + 1), 0, lines_spanned - 2, adjusted_height]
-                                    middle_lines = np.multiply(middle_lines, adjusted_ratio)
-                                    rle_list.append(middle_lines)
-                                    
-                                # Insert right-most line
-                                right_line = [x2, 0, 1, y2]
-                                right_line = np.multiply(right_line, adjusted_ratio)
-                                rle_list.append(right_line)
-                                
-                    if len(rle_list) > 0:
-                        rle_regions[seg['id']] = rle_list
-
-        html = self.create_html(image_id, image_path, mask_path, adjusted_width, adjusted_height,
-                                show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes, html, show_mask_image,item_in_page)
-
-        return html
-
-    def create_html(self, image_id, image_path, mask_path, adjusted_width, adjusted_height, show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes, html, show_mask_image, item_in_page):
+                    # Decode the RLE and render it as one semi-transparent overlay at display size
+                    rle_regions[seg['id']] = self.create_rle_overlay(
+                        seg['segmentation'], seg_colors[seg['id']], adjusted_width, adjusted_height)
+
+        # with a buffer the markup is written into it and nothing is returned
+        return self.create_html(image_id, image_path, mask_path, adjusted_width, adjusted_height,
+                                show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes, html, show_mask_image,item_in_page,
+                                buffer)
+
+    def decode_rle(self, rle):
+        # Decodes COCO RLE (column-major counts), uncompressed or compressed to a
+        # string, into a (height, width) bool mask
+        height, width = rle['size']
+        if isinstance(rle['counts'], (str, bytes)):
+            counts = decode_counts(rle['counts'])
+        else:
+            counts = np.asarray(rle['counts'], dtype=np.int64)
+
+        if np.any(counts < 0):
+            print(f'ERROR: One of the counts was negative, treating as 0: {counts[counts < 0].tolist()}')
+            counts = np.maximum(counts, 0)
+
+        # counts alternate between empty and filled runs, starting with empty ones
+        pixels = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
+        if pixels.size != height * width:
+            # tolerate counts that do not add up to the mask size
+            pixels = np.pad(pixels[:height * width], (0, max(0, height * width - pixels.size)))
+
+        return pixels.reshape((height, width), order='F')
+
+    def create_rle_overlay(self, rle, color, adjusted_width, adjusted_height):
+        # Renders a crowd mask as a colored, semi-transparent PNG of the display size
+        display_size = (int(adjusted_width), max(1, round(adjusted_height)))
+        mask = PILImage.fromarray(self.decode_rle(rle).astype(np.uint8) * 255)
+        alpha = mask.resize(display_size, PILImage.BILINEAR, reducing_gap=3.0).point(lambda value: value // 2)
+
+        overlay = PILImage.new('RGBA', display_size, ImageColor.getrgb(color))
+        overlay.putalpha(alpha)
+
+        buffer = BytesIO()
+        overlay.save(buffer, format='PNG')
+
+        data_uri = base64.b64encode(buffer.getvalue()).decode('ascii')
+        return "data:image/png;base64,{0}".format(data_uri), display_size
+
+    def format_svg_points(self, seg_points, ratio):
+        # Scales a flat [x1, y1, x2, y2, ...] polygon and formats it as SVG points "x1,y1 x2,y2 ..."
+        points = np.multiply(seg_points, ratio).astype(int).reshape(-1, 2).astype(str)
+        return ' '.join(np.char.add(np.char.add(points[:, 0], ','), points[:, 1]).tolist())
+
+    def create_html(self, image_id, image_path, mask_path, adjusted_width, adjusted_height, show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes, html, show_mask_image, item_in_page, buffer=None):
 
         segs = 0
         if(len(bboxes) > 0):
             segs = len(self.segmentations[image_id])
 
-        # Draw the image
-        html += f'<b>Image: {image_id} - Segmentations: {segs}  - Size (w/h): {adjusted_width}px/{adjusted_height}px</b><br />'
-        html += f'<div class="container" >'        
-        html += f'<img src="{str(image_path)}" />'
+        # Writes the image markup into buffer, or returns it as a string when no buffer is given
+        html_buffer = buffer if buffer is not None else StringIO()
+        html_buffer.write(html)
 
-        svg = f'<svg>'
-        svg += self.get_shapes_as_svg(show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes)
-        svg += f'</svg>'
-        html += svg
+        # The shapes are the same over the image and over the mask
+        shapes = StringIO()
+        self.get_shapes_as_svg(show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes, shapes)
+        shapes = shapes.getvalue()
+
+        # Draw the image
+        html_buffer.write(f'<b>Image: {image_id} - Segmentations: {segs}  - Size (w/h): {adjusted_width}px/{adjusted_height}px</b><br />')
+        html_buffer.write('<div class="container" >')
+        html_buffer.write(f'<img src="{str(image_path)}" />')
+        html_buffer.write(f'<svg>{shapes}</svg>')
 
         # Draw the mask image
         if(show_mask_image):
-            html += f'<img src="{str(mask_path)}" />'
-        
-            svg = f'<svg style="top:{adjusted_height}px !important;" >'
-            svg += self.get_shapes_as_svg(show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes)
-            svg += f'</svg>'
-            html += svg
-        
-        
-        html += '</div>'
-
-        return html
-
-    def get_shapes_as_svg(self, show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes):        
-        
-        svg_html = f''
+            html_buffer.write(f'<img src="{str(mask_path)}" />')
+            html_buffer.write(f'<svg style="top:{adjusted_height}px !important;" >{shapes}</svg>')
+
+        html_buffer.write('</div>')
+
+        if buffer is None:
+            return html_buffer.getvalue()
+
+    def get_shapes_as_svg(self, show_polys, polygons, show_crowds, rle_regions, seg_colors, show_bbox, bboxes, buffer=None):
+        # Writes the shapes into buffer, or returns them as a string when no buffer is given
+        svg_html = buffer if buffer is not None else StringIO()
 
         # Draw shapes on image
         if show_polys:
-            for seg_id, points_list in polygons.items():                
-                for i, point in enumerate(points_list):
-                    converted_list = ''
-                    lst = point.split(' ')
-                    lst = [x.strip() for x in lst if x.strip()]
-                    converted_list = ' '.join([str(k) + ',' if j % 2 == 0 else str(k) for j, k in enumerate(lst)])
-
-                    svg_html += f'<polygon points="{converted_list}" style="fill:{seg_colors[seg_id]}; stroke:{seg_colors[seg_id]}; fill-opacity:0.3; stroke-width:1;" />' 
-        
+            for seg_id, points_list in polygons.items():
+                for points in points_list:
+                    svg_html.write(f'<polygon points="{points}" style="fill:{seg_colors[seg_id]}; stroke:{seg_colors[seg_id]}; fill-opacity:0.3; stroke-width:1;" />')
+
         if show_crowds == 1 or show_crowds == True:
-            for seg_id, line_list in rle_regions.items():
-                for line in line_list:
-                    svg_html += f'<rect x="{line[0]}" y="{line[1]}" width="{line[2]}" height="{line[3]}" style="fill:{seg_colors[seg_id]}; stroke:{seg_colors[seg_id]}; fill-opacity:0.5; stroke-opacity:0.5" />'
+            for seg_id, (overlay_uri, overlay_size) in rle_regions.items():
+                svg_html.write(f'<image href="{overlay_uri}" x="0" y="0" width="{overlay_size[0]}" height="{overlay_size[1]}" />')
 
         if show_bbox:
             for seg_id, bbox in bboxes.items():
-                svg_html += f'<rect x="{bbox[0]}" y="{bbox[1]}" width="{bbox[2]}" height="{bbox[3]}" style="fill:{seg_colors[seg_id]}; stroke:{seg_colors[seg_id]}; fill-opacity:0.3; stroke-opacity:0.3" />'
+                svg_html.write(f'<rect x="{bbox[0]}" y="{bbox[1]}" width="{bbox[2]}" height="{bbox[3]}" style="fill:{seg_colors[seg_id]}; stroke:{seg_colors[seg_id]}; fill-opacity:0.3; stroke-opacity:0.3" />')
 
-        return svg_html
+        if buffer is None:
+            return svg_html.getvalue()
 
     def get_css(self):
         css = "<style>"
@@ -383,6 +470,18 @@ if __name__ == "__main__":
                         default="hedychium_coronarium", help="path to root of datasets")
     parser.add_argument("-b", "--base_path", dest="base_path",
                         default="../images/train/", help="base path to images")
+    parser.add_argument("-ix", "--use_index", dest="use_index", default=1, type=int,
+                        help="open the annotations through a sidecar byte-range index: 0 or 1")
+    parser.add_argument("-jb", "--json_backend", dest="json_backend", default="json", choices=["json", "orjson", "auto"],
+                        help="json decoder, orjson is faster and falls back to json when not installed")
+    parser.add_argument("-uc", "--use_columns", dest="use_columns", default=1, type=int,
+                        help="open the annotations from the columnar files when they exist: 0 or 1")
+    parser.add_argument("-if", "--image_format", dest="image_format", default="PNG", choices=["PNG", "JPEG", "WEBP"],
+                        help="format of the images embedded in the HTML")
+    parser.add_argument("-iq", "--image_quality", dest="image_quality", default=85, type=int,
+                        help="quality of JPEG/WEBP embedded images")
+    parser.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                        help="number of worker processes, 1 to run serially")
 
     #args = parser.parse_args()
 
@@ -0,0 +1,203 @@
+import json
+import mmap
+import os
+import re
+from collections.abc import Mapping
+
+import numpy as np
+
+from atomic_write import atomic_open
+
+
+class LazyJsonMapping(Mapping):
+    """ A read-only mapping whose values are parsed from byte ranges of a json file on access
+
+        keys are kept in file order. With many=True every key has a list of values
+        (e.g. the annotations of an image), otherwise a single value.
+    """
+
+    def __init__(self, source, keys, ranges, group_bounds=None, loads=json.loads):
+        self.source = source
+        self.loads = loads
+        self.keys_in_order = keys
+        self.ranges = ranges
+        self.group_bounds = group_bounds
+
+        self.sort_order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.sort_order]
+
+    def _position(self, key):
+        i = np.searchsorted(self.sorted_keys, key)
+        if i >= len(self.sorted_keys) or self.sorted_keys[i] != key:
+            raise KeyError(key)
+        return self.sort_order[i]
+
+    def _load(self, start, end):
+        return self.loads(self.source[start:end])
+
+    def __getitem__(self, key):
+        try:
+            position = self._position(key)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+
+        if self.group_bounds is None:
+            return self._load(*self.ranges[position])
+
+        first, last = self.group_bounds[position]
+        return [self._load(start, end) for start, end in self.ranges[first:last]]
+
+    def __iter__(self):
+        return (key.item() for key in self.keys_in_order)
+
+    def __len__(self):
+        return len(self.keys_in_order)
+
+
+class CocoIndex():
+    """ Sidecar index of a COCO json file, for fast startup of CocoDataset
+
+        The index stores the byte range of every image and every annotation (grouped by
+        image_id) and of the small top-level sections, so opening a dataset only loads a
+        few arrays and each image or segmentation list is parsed when it is accessed.
+        It is built once, next to the json file, and rebuilt whenever the json's size
+        or mtime change.
+    """
+
+    INDEX_VERSION = 1
+
+    # json strings (with escapes) and the brackets outside of them
+    TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+    def __init__(self, json_path, index_path=None, loads=json.loads):
+        self.json_path = json_path
+        self.index_path = index_path or f'{json_path}.idx.npz'
+        # decodes the images and annotations, e.g. JsonSerializer.loads
+        self.loads = loads
+
+    def load(self):
+        if not self.is_valid():
+            self.build()
+
+        with np.load(self.index_path) as index:
+            self.meta = json.loads(index['meta'].item())
+            image_ids = index['image_ids']
+            image_ranges = index['image_ranges']
+            segmentation_image_ids = index['segmentation_image_ids']
+            segmentation_bounds = index['segmentation_bounds']
+            annotation_ranges = index['annotation_ranges']
+
+        self.json_file = open(self.json_path, 'rb')
+        self.source = self._map(self.json_file)
+
+        self.images = LazyJsonMapping(self.source, image_ids, image_ranges, loads=self.loads)
+        self.segmentations = LazyJsonMapping(
+            self.source, segmentation_image_ids, annotation_ranges, segmentation_bounds, loads=self.loads)
+
+        return self
+
+    def close(self):
+        self.source.close()
+        self.json_file.close()
+
+    def load_sections(self, names):
+        """ Parses the small top-level sections (e.g. info, licenses, categories)
+        """
+        return {name: self.loads(self.source[start:end])
+                for name, (start, end) in self.meta['sections'].items() if name in names}
+
+    def is_valid(self):
+        if not os.path.exists(self.index_path):
+            return False
+
+        try:
+            with np.load(self.index_path) as index:
+                meta = json.loads(index['meta'].item())
+        except (OSError, ValueError, KeyError):
+            return False
+
+        stat = os.stat(self.json_path)
+        return (meta.get('version') == self.INDEX_VERSION and
+                meta.get('source_size') == stat.st_size and
+                meta.get('source_mtime_ns') == stat.st_mtime_ns)
+
+    def build(self):
+        """ Scans the json file once, without loading it into memory, and writes the index
+        """
+        stat = os.stat(self.json_path)
+        sections = dict()
+        elements = {'images': [], 'annotations': []}
+
+        with open(self.json_path, 'rb') as json_file:
+            source = self._map(json_file)
+
+            depth = 0
+            key = None
+            section = None
+            for token in self.TOKENS.finditer(source):
+                char = source[token.start()]
+
+                if char == ord('"'):
+                    if depth == 1:
+                        key = token.group()
+                    continue
+
+                if char == ord('[') or char == ord('{'):
+                    depth += 1
+                    if depth == 2:
+                        section = json.loads(key)
+                        section_start = token.start()
+                    elif depth == 3 and section in elements:
+                        element_start = token.start()
+                else:
+                    if depth == 3 and section in elements:
+                        elements[section].append((element_start, token.end()))
+                    elif depth == 2:
+                        sections[section] = (section_start, token.end())
+                    depth -= 1
+
+            # images keep the first of any duplicate id, like CocoDataset does
+            image_ids = []
+            image_ranges = []
+            seen_image_ids = set()
+            for start, end in elements['images']:
+                image_id = json.loads(source[start:end])['id']
+                if image_id not in seen_image_ids:
+                    seen_image_ids.add(image_id)
+                    image_ids.append(image_id)
+                    image_ranges.append((start, end))
+
+            annotation_image_ids = np.array(
+                [json.loads(source[start:end])['image_id'] for start, end in elements['annotations']],
+                dtype=np.int64)
+
+            source.close()
+
+        # group annotations by image, keeping the file order inside each group
+        order = np.argsort(annotation_image_ids, kind='stable')
+        annotation_ranges = np.array(elements['annotations'], dtype=np.int64).reshape(-1, 2)[order]
+        segmentation_image_ids, group_starts = np.unique(
+            annotation_image_ids[order], return_index=True)
+        group_ends = np.append(group_starts[1:], len(order)) if group_starts.size else group_starts
+
+        meta = {
+            'version': self.INDEX_VERSION,
+            'source_size': stat.st_size,
+            'source_mtime_ns': stat.st_mtime_ns,
+            'sections': {name: section_range for name, section_range in sections.items()
+                         if name not in elements}
+        }
+
+        with atomic_open(self.index_path, 'wb') as index_file:
+            np.savez(index_file,
+                     meta=np.array(json.dumps(meta)),
+                     image_ids=np.array(image_ids, dtype=np.int64),
+                     image_ranges=np.array(image_ranges, dtype=np.int64).reshape(-1, 2),
+                     segmentation_image_ids=segmentation_image_ids.astype(np.int64),
+                     segmentation_bounds=np.stack((group_starts, group_ends), axis=1).astype(np.int64),
+                     annotation_ranges=annotation_ranges)
+
+    def _map(self, json_file):
+        if os.fstat(json_file.fileno()).st_size == 0:
+            raise ValueError(f'empty json file: {self.json_path}')
+        return mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ)
@@ -1,7 +1,6 @@
 #!/usr/bin/python
 
 import numpy as np
-import json
 from pathlib import Path
 from tqdm import tqdm
 from skimage import measure, io
@@ -10,6 +9,12 @@ from PIL import Image
 import os
 import glob
 import sys
+from coco_json_writer import CocoJsonWriter
+from annotation_cache import AnnotationCache
+from json_serializer import JsonSerializer
+from packed_mask import PackedMask
+from run_stats import RunStats, profiled, timed
+from worker_pool import map_timed_tasks
 
 
 class InfoJsonUtils():
@@ -75,14 +80,7 @@ class ImageJsonUtils():
     def create_coco_image(self, image_path, image_id, image_license):
         """ Creates the "image" portion of COCO json
         """
-        if(self.resize_width > 0 and self.resize_height > 0):
-            image_file = self.resize(Image.open(
-                image_path), self.resize_width, self.resize_height)
-        else:
-            # Open the image and get the size
-            image_file = Image.open(image_path)
-
-        width, height = image_file.size
+        width, height = self.get_image_size(image_path)
 
         image = dict()
         image['license'] = image_license
@@ -93,6 +91,17 @@ class ImageJsonUtils():
 
         return image
 
+    def get_image_size(self, image_path):
+        """ Returns the (width, height) the image has after resizeToDefaultSize,
+            reading only the file header and never decoding the pixel data
+        """
+        # Image.open is lazy, it only parses the header until the pixels are accessed,
+        # it is still opened with a resize size so missing or unreadable images fail here
+        with Image.open(image_path) as image_file:
+            if(self.resize_width > 0 and self.resize_height > 0):
+                return self.resize_width, self.resize_height
+            return image_file.size
+
     def resizeProportional(self, img, basewidth):
         wpercent = (basewidth/float(img.size[0]))
         hsize = int((float(img.size[1])*float(wpercent)))
@@ -114,17 +123,23 @@ class AnnotationJsonUtils():
     args = None
     imgJsonUtils = ImageJsonUtils()
 
+    # an optional RunStats, the decode/resize/isolate/contour stages are timed into it
+    stats = None
+    verbose = True
+
     def __init__(self):
         self.annotation_id_index = 0
 
     def setArgs(self, args):
         self.args = args
+        self.verbose = args.verbose
         self.imgJsonUtils.setDefaultSizes(args)
 
-    def create_coco_annotations(self, image_mask_path, image_id, category_ids):
+    def create_coco_annotations(self, image_mask_path, image_id, category_ids, mask_image=None):
         """ Takes a pixel-based RGB image mask and creates COCO annotations.
         Args:
             image_mask_path: a pathlib.Path to the image mask
+            mask_image: the mask already opened as a PIL image, image_mask_path is not read then
             image_id: the integer image id
             category_ids: a dictionary of integer category ids keyed by RGB color (a tuple converted to a string)
                 e.g. {'(255, 0, 0)': {'category': 'owl', 'super_category': 'bird'} }
@@ -154,46 +169,86 @@ class AnnotationJsonUtils():
             break
 
         # Open and process image
-        img = self.imgJsonUtils.resizeToDefaultSize(
-            Image.open(image_mask_path))
+        with timed(self.stats, 'decode'):
+            img = mask_image if mask_image is not None else Image.open(image_mask_path)
+            img.load()
+        with timed(self.stats, 'resize'):
+            img = self.imgJsonUtils.resizeToDefaultSize(img)
         self.mask_image = img
         # self.mask_image = self.mask_image.convert('RGB')
         self.width, self.height = self.mask_image.size
 
         # Split up the multi-colored masks into multiple 0/1 bit masks
-        self._isolate_masks()
+        with timed(self.stats, 'isolate'):
+            self._isolate_masks()
 
         # Create annotations from the masks
-        self._create_annotations()
+        with timed(self.stats, 'contour'):
+            self._create_annotations()
 
         return self.annotations
 
     def _isolate_masks(self):
         # Breaks mask up into isolated masks based on color
 
-        t = self.width * self.height
-        n = self.width * self.height
+        labels, bands = self._color_labels(self.mask_image)
+
+        # Scan column by column, like the original per-pixel loop did, so the
+        # masks keep the order in which their colors first appear
+        flat_labels = labels.ravel(order='F')
+        colors, first_index, inverse, counts = np.unique(
+            flat_labels, return_index=True, return_inverse=True, return_counts=True)
+
+        # Group the flat pixel positions by color with a single sort
+        positions = np.argsort(inverse.ravel(), kind='stable')
+        positions_by_color = np.split(positions, np.cumsum(counts)[:-1])
 
         self.isolated_masks = dict()
-        for x in range(self.width):
-            for y in range(self.height):
-                pixel_rgb = self.mask_image.getpixel((x, y))
-                pixel_rgb_str = str(pixel_rgb)
-
-                # If the pixel is any color other than black, add it to a respective isolated image mask
-                if not pixel_rgb == (0, 0, 0):
-                    if self.isolated_masks.get(pixel_rgb_str) is None:
-                        # Isolated mask doesn't have its own image yet, create one
-                        # with 1-bit pixels, default black. Make room for 1 pixel of
-                        # padding on each edge to allow the contours algorithm to work
-                        # when shapes bleed up to the edge
-                        self.isolated_masks[pixel_rgb_str] = Image.new(
-                            '1', (self.width + 2, self.height + 2))
-                        n -= 1
-
-                    # Add the pixel to the mask image, shifting by 1 pixel to account for padding
-                    self.isolated_masks[pixel_rgb_str].putpixel(
-                        (x + 1, y + 1), 1)
+        for color_index in np.argsort(first_index, kind='stable'):
+            pixel_rgb = self._color_key(colors[color_index], bands)
+
+            # If the pixel is any color other than black, add it to a respective isolated image mask
+            if pixel_rgb == (0, 0, 0):
+                continue
+
+            # Only the color's bounding region is kept, with room for 1 pixel of
+            # padding on each edge to allow the contours algorithm to work when
+            # shapes bleed up to the edge
+            cols, rows = np.divmod(positions_by_color[color_index], self.height)
+            top, left = rows.min(), cols.min()
+            isolated_mask = np.zeros(
+                (rows.max() - top + 3, cols.max() - left + 3), dtype=np.bool_)
+            isolated_mask[rows - top + 1, cols - left + 1] = True
+
+            # stored bit-packed, _create_annotations unpacks one mask at a time
+            self.isolated_masks[str(pixel_rgb)] = PackedMask.from_array(
+                isolated_mask, offset=(top - 1, left - 1))
+
+    def _color_labels(self, image):
+        # Packs the bands of every pixel into a single integer label
+
+        if image.mode == '1':
+            image = image.convert('L')
+
+        pixels = np.asarray(image)
+        if pixels.ndim == 2:
+            return pixels, 1
+
+        bands = pixels.shape[2]
+        labels = np.zeros(pixels.shape[:2], dtype=np.uint64)
+        for band in range(bands):
+            labels |= pixels[:, :, band].astype(np.uint64) << np.uint64(8 * band)
+
+        return labels, bands
+
+    def _color_key(self, label, bands):
+        # Unpacks an integer label back into the pixel value PIL's getpixel returns
+
+        if bands == 1:
+            return label.item()
+
+        label = int(label)
+        return tuple((label >> (8 * band)) & 0xFF for band in range(bands))
 
     def _create_annotations(self):
         # Creates annotations for each isolated mask
@@ -218,17 +273,16 @@ class AnnotationJsonUtils():
             annotation['category_id'] = self.category_ids[key]
             annotation['id'] = self._next_annotation_id()
 
-            # Find contours in the isolated mask
+            # Find contours in the isolated mask, which only covers the color's region
+            offset_row, offset_col = mask.offset
             mask = np.asarray(mask, dtype=np.float32)
             contours = measure.find_contours(mask, 0.1, positive_orientation='low')
 
             polygons = []
             for contour in contours:
                 # Flip from (row, col) representation to (x, y)
-                # and subtract the padding pixel
-                for i in range(len(contour)):
-                    row, col = contour[i]
-                    contour[i] = (col - 1, row - 1)
+                # and move the padded crop back to its place in the image
+                contour = np.flip(contour, axis=1) + (offset_col, offset_row)
 
                 # Make a polygon and simplify it
                 poly = Polygon(contour)
@@ -263,6 +317,9 @@ class AnnotationJsonUtils():
             # Finally, add this annotation to the list
             self.annotations.append(annotation)
 
+        if not self.verbose:
+            return
+
         if(len(self.annotations) == 0):
             print(
                 f'annotation [NOT] found for image - image_id: {self.image_id}')
@@ -311,8 +368,59 @@ class AnnotationJsonUtils():
         print(f' annotation [WAS] found for image - image_id: {self.image_id}')
 
 
+def create_image_and_annotations(args, image_path, mask_path, image_id, image_license, category_ids_by_rgb, cache=None,
+                                 stats=None, decoded_images=None):
+    """ Creates the image json item and the annotations of a single mask definition
+    Args:
+        decoded_images: an optional DecodedImages, shared with other generators so every
+            file is opened and decoded only once
+    Returns:
+        image_obj, annotation_obj and how many annotation ids were used, starting at 0
+    """
+    iju = ImageJsonUtils()
+    iju.setArgs(args)
+
+    aju = AnnotationJsonUtils()
+    aju.setArgs(args)
+    aju.stats = stats
+
+    # Create a coco image json item
+    image_obj = iju.create_coco_image(
+        image_path,
+        image_id,
+        image_license)
+
+    cached = None
+    if cache is not None:
+        with timed(stats, 'cache'):
+            cache_key = cache.key(mask_path, {
+                'width': args.width, 'height': args.height, 'iscrowd': args.iscrowd,
+                'category_ids_by_rgb': category_ids_by_rgb})
+            cached = cache.get(cache_key)
+
+    if cached is not None:
+        # cached annotations are numbered from 0 like a fresh AnnotationJsonUtils
+        for annotation in cached['annotations']:
+            annotation['image_id'] = image_id
+        return image_obj, cached['annotations'], cached['annotation_id_count']
+
+    mask_image = decoded_images.open(mask_path) if decoded_images is not None else None
+    annotation_obj = aju.create_coco_annotations(
+        mask_path, image_id, category_ids_by_rgb, mask_image=mask_image)
+
+    if cache is not None:
+        with timed(stats, 'cache'):
+            cache.put(cache_key, {
+                'annotations': annotation_obj, 'annotation_id_count': aju.annotation_id_index})
+
+    return image_obj, annotation_obj, aju.annotation_id_index
+
+
 class CocoJsonCreator():
 
+    # RunStats of the last run, created by main or by the first iter_images_and_annotations
+    stats = None
+
     def validate_and_process_args(self, args):
         """ Validates the arguments coming in from the command line and performs
             initial processing
@@ -322,6 +430,7 @@ class CocoJsonCreator():
         self.instances_json = args.instances_json
         self.dataset_dir = '' #args.base_path + args.database_name + '/'
         self.dataset_info = args.dataset_info
+        self.serializer = JsonSerializer(args.json_backend, args.json_precision)
 
         if(args.generate_automatic_info == 1):
             at = GenerateAutomaticInfo()
@@ -340,7 +449,7 @@ class CocoJsonCreator():
 
         # Load the mask definition json
         with open(mask_definition_file) as json_file:
-            self.mask_definitions = json.load(json_file)
+            self.mask_definitions = self.serializer.load(json_file)
 
         self.dataset_dir = mask_definition_file.parent
 
@@ -352,7 +461,7 @@ class CocoJsonCreator():
 
         # Load the dataset info json
         with open(dataset_info_file) as json_file:
-            self.dataset_info = json.load(json_file)
+            self.dataset_info = self.serializer.load(json_file)
 
         assert 'info' in self.dataset_info, 'dataset_info JSON was missing "info"'
         assert 'license' in self.dataset_info, 'dataset_info JSON was missing "license"'
@@ -410,34 +519,56 @@ class CocoJsonCreator():
         """ Creates the list of images (in json) and the annotations for each
             image for the "image" and "annotations" portions of the COCO json
         """
-        iju = ImageJsonUtils()
-        iju.setArgs(args)
-
-        aju = AnnotationJsonUtils()
-        aju.setArgs(args)
-
         image_objs = []
         annotation_objs = []
-        image_id = 1
 
-        image_license = self.dataset_info['license']['id']
+        for image_obj, annotation_obj in self.iter_images_and_annotations(args, category_ids_by_name):
+            image_objs.append(image_obj)
+            annotation_objs += annotation_obj  # Add the new annotations to the existing list
 
-        mask_count = len(self.mask_definitions['annotations'])
-        print(f'Processing {mask_count} mask definitions...')
+        return image_objs, annotation_objs
+
+    def iter_images_and_annotations(self, args, category_ids_by_name=None):
+        """ Yields the image (in json) and its annotations one mask definition
+            at a time, in definition order, numbered as they are in the json file.
+            Results are computed at most a few images ahead, also with workers, so a
+            data loader can consume them with bounded memory.
+        Args:
+            category_ids_by_name: from create_categories, when None the args are
+                validated and the categories created here
+        """
+        if category_ids_by_name is None:
+            self.validate_and_process_args(args)
+            _, category_ids_by_name = self.create_categories()
+
+        self.setup(args)
+        tasks = self.create_tasks(args, category_ids_by_name)
+        print(f'Processing {len(tasks)} mask definitions...')
+
+        results = map_timed_tasks(create_image_and_annotations, tasks, self.workers)
+        for result, stages in tqdm(results, total=len(tasks), mininterval=args.progress_interval):
+            self.stats.merge(stages)
+            image_obj, annotation_obj = self.add_result(result)
+
+            self.stats.add_image(image_obj['width'], image_obj['height'], len(annotation_obj))
+            yield image_obj, annotation_obj
+
+    def setup(self, args):
+        self.workers = args.workers
+        self.cache = self.create_cache(args)
+        self.annotation_id_offset = 0
+        if self.stats is None:
+            self.stats = RunStats('CocoJsonCreator', progress_interval=args.progress_interval)
+
+    def create_tasks(self, args, category_ids_by_name):
+        """ Creates the create_image_and_annotations arguments of every mask definition
+        """
+        image_license = self.dataset_info['license']['id']
 
         # For each mask definition, create image and annotations
-        # comentado
-        for file_name, mask_def in tqdm(self.mask_definitions['annotations'].items()):
-            # for file_name, mask_def in list(self.mask_definitions['annotations'].items()):
-            # Create a coco image json item
+        tasks = []
+        for image_id, (file_name, mask_def) in enumerate(self.mask_definitions['annotations'].items(), start=1):
             image_path = Path(args.base_path) / file_name
-            image_obj = iju.create_coco_image(
-                image_path,
-                image_id,
-                image_license)
-
-            image_objs.append(image_obj)
-
             mask_path = Path(args.base_path) / mask_def['annotations']
 
             # Create a dict of category ids keyed by rgb_color
@@ -445,39 +576,83 @@ class CocoJsonCreator():
             for rgb_color, category in mask_def['color_categories'].items():
                 category_ids_by_rgb[rgb_color] = category_ids_by_name[category['category']]
 
-            annotation_obj = aju.create_coco_annotations(
-                mask_path, image_id, category_ids_by_rgb)
-            annotation_objs += annotation_obj  # Add the new annotations to the existing list
+            tasks.append((args, image_path, mask_path, image_id,
+                          image_license, category_ids_by_rgb, self.cache))
 
-            image_id += 1
+        return tasks
 
-        return image_objs, annotation_objs
+    def add_result(self, result):
+        """ Takes the results in task order and returns the image and its annotations
+        """
+        image_obj, annotation_obj, annotation_id_count = result
+
+        # Every task numbers its annotations from 0, shift them by the ids the
+        # previous images used so the result matches a serial run
+        for annotation in annotation_obj:
+            annotation['id'] += self.annotation_id_offset
+        self.annotation_id_offset += annotation_id_count
+
+        return image_obj, annotation_obj
+
+    def create_cache(self, args):
+        """ Creates the per-mask annotation cache, or None when args.cache_dir is not set
+        """
+        if not args.cache_dir:
+            return None
+
+        return AnnotationCache(
+            args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024, key_mode=args.cache_key)
+
+    def create_coco_output(self):
+        """ Creates the COCO dict, with empty "images" and "annotations" to be streamed
+        Returns:
+            the COCO dict and the category ids by name
+        """
+        info = self.create_info()
+        licenses = self.create_licenses()
+
+        categories, category_ids_by_name = self.create_categories()
+        master_obj = {
+            'info': info,
+            'licenses': licenses,
+            'images': [],
+            'annotations': [],
+            'categories': categories
+        }
+
+        return master_obj, category_ids_by_name
 
     def main(self, args):
         self.validate_and_process_args(args)
 
         if(args.generate_automatic_info == 1):            
-            info = self.create_info()        
-            licenses = self.create_licenses()
-
-            categories, category_ids_by_name = self.create_categories()
-            images, annotations = self.create_images_and_annotations(
-                args, category_ids_by_name) 
-            master_obj = {
-                'info': info,
-                'licenses': licenses,
-                'images': images,
-                'annotations': annotations,
-                'categories': categories
-            }
+            master_obj, category_ids_by_name = self.create_coco_output()
+
+            self.stats = RunStats('CocoJsonCreator', progress_interval=args.progress_interval)
 
-            # Write the json to a file
+            # Write the json to a file, streaming images and annotations as each image finishes
             output_path = Path(self.dataset_dir) / args.instances_json
-            with open(output_path, 'w+') as output_file:
-                json.dump(master_obj, output_file)
+            with profiled(args.profile_path):
+                columns_dir = output_path.with_suffix('.columns') if args.columnar_output else None
+                with CocoJsonWriter(output_path, master_obj, streams=['images', 'annotations'],
+                                    columns_dir=columns_dir, serializer=self.serializer) as writer:
+                    for image_obj, annotation_obj in self.iter_images_and_annotations(args, category_ids_by_name):
+                        with self.stats.stage('serialize'):
+                            writer.write('images', image_obj)
+                            writer.write_items('annotations', annotation_obj)
+
+                    with self.stats.stage('serialize'):
+                        writer.close()
 
             print(f'CocoJSONUtils - Annotations successfully written to file:\n{output_path}')
 
+            if args.run_report:
+                self.stats.save(output_path.with_suffix('.report.json'))
+
+            if self.cache is not None:
+                evicted = self.cache.evict()
+                print(f'CocoJSONUtils - cache: {evicted} entries evicted')
+
 
 class GenerateAutomaticInfo():
     """ Generate Automatic Infos for the COCO dataset
@@ -528,12 +703,12 @@ class GenerateAutomaticInfo():
         output_path = Path(self.base_path) / self.mask_definition
 
         with open(output_path, 'w+') as output_file:
-            json.dump(masks_json, output_file)
+            self.serializer.dump(masks_json, output_file)
 
         print(f'CocoJSONUtils - masks successfully written to file: {output_path}\n\n')
 
         with open(output_path) as json_file:
-            self.instances_json = json.load(json_file)
+            self.instances_json = self.serializer.load(json_file)
 
     def infos(self, ext=''):
         dataset_info = {
@@ -554,12 +729,12 @@ class GenerateAutomaticInfo():
 
         output_path = Path(self.base_path) / 'dataset_info.json'
         with open(output_path, 'w+') as output_file:
-            json.dump(dataset_info, output_file)
+            self.serializer.dump(dataset_info, output_file)
 
         print(f'CocoJSONUtils - database successfully written to file: {output_path}\n\n')
 
         with open(output_path) as json_file:
-            self.dataset_info = json.load(json_file)
+            self.dataset_info = self.serializer.load(json_file)
 
     def main(self, args):
         self.base_path = args.base_path
@@ -568,6 +743,7 @@ class GenerateAutomaticInfo():
         self.database_name = args.database_name
         self.instances_json = args.instances_json
         self.mask_definition = args.mask_definition
+        self.serializer = JsonSerializer(args.json_backend)
 
         self.validate_images()
         self.masks()
@@ -609,6 +785,39 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--masks_path", dest="masks_path",
                         default="annotations/", help="path to masks")
 
+    parser.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                        help="number of worker processes, 1 to run serially")
+
+    parser.add_argument("-cd", "--cache_dir", dest="cache_dir", default=None,
+                        help="directory of the per-mask annotation cache, disabled when empty")
+
+    parser.add_argument("-cm", "--cache_max_mb", dest="cache_max_mb", default=1024, type=int,
+                        help="cache size in MB, least recently used entries are evicted above it")
+
+    parser.add_argument("-ck", "--cache_key", dest="cache_key", default="content", choices=["content", "stat"],
+                        help="key masks by their content hash or by their size and mtime")
+
+    parser.add_argument("-rr", "--run_report", dest="run_report", default=1, type=int,
+                        help="write a json run report with stage timings and throughput next to the output: 0 or 1")
+
+    parser.add_argument("-pi", "--progress_interval", dest="progress_interval", default=5.0, type=float,
+                        help="minimum seconds between progress updates")
+
+    parser.add_argument("-pp", "--profile_path", dest="profile_path", default=None,
+                        help="run under cProfile and save the stats to this path (main process only)")
+
+    parser.add_argument("-co", "--columnar_output", dest="columnar_output", default=0, type=int,
+                        help="also write the annotations as memory-mappable columns next to the json: 0 or 1")
+
+    parser.add_argument("-jb", "--json_backend", dest="json_backend", default="json", choices=["json", "orjson", "auto"],
+                        help="json encoder/decoder, orjson is faster and falls back to json when not installed")
+
+    parser.add_argument("-jp", "--json_precision", dest="json_precision", default=None, type=int,
+                        help="decimals kept in polygon, bbox and area values, full precision when empty")
+
+    parser.add_argument("-v", "--verbose", dest="verbose", default=0, type=int,
+                        help="print a line per image/annotation: 0 or 1")
+
     args = parser.parse_args()
 
     cjc = CocoJsonCreator()
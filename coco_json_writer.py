@@ -0,0 +1,102 @@
+import shutil
+import tempfile
+
+from atomic_write import atomic_open
+from coco_columns import CocoColumnsWriter
+from json_serializer import JsonSerializer
+
+
+class CocoJsonWriter():
+    """ Writes a COCO json file incrementally, one array element at a time
+
+        coco_output is the complete COCO dict, with the streamed keys (e.g. "images"
+        and "annotations") present as placeholders to keep the key order. Each
+        streamed array is spooled to its own temporary file while the dataset is
+        processed, so memory stays bounded by the items being written. close()
+        assembles the final file next to output_path and moves it into place, the
+        result is byte-for-byte what json.dump(coco_output) would have written.
+
+        Items are encoded by serializer, a JsonSerializer (the json module by
+        default), which also rounds the annotations to its precision.
+
+        With columns_dir, the same items are also written in the columnar format
+        of CocoColumnsWriter.
+    """
+
+    def __init__(self, output_path, coco_output, streams=('images', 'annotations'), columns_dir=None,
+                 serializer=None):
+        self.output_path = output_path
+        self.coco_output = coco_output
+        self.streams = list(streams)
+        self.serializer = serializer or JsonSerializer()
+
+        self.columns_writer = None
+        if columns_dir:
+            self.columns_writer = CocoColumnsWriter(columns_dir, coco_output, streams, source_path=output_path)
+
+        for stream in self.streams:
+            if stream not in self.coco_output:
+                raise KeyError(f'coco_output is missing the streamed key "{stream}"')
+
+        self.spools = {stream: tempfile.TemporaryFile(mode='w+') for stream in self.streams}
+        self.counts = {stream: 0 for stream in self.streams}
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, stream, item):
+        if stream == 'annotations':
+            item = self.serializer.round_annotation(item)
+
+        spool = self.spools[stream]
+        if self.counts[stream] > 0:
+            spool.write(', ')
+        self.serializer.dump(item, spool)
+        self.counts[stream] += 1
+
+        if self.columns_writer is not None:
+            self.columns_writer.write(stream, item)
+
+    def write_items(self, stream, items):
+        for item in items:
+            self.write(stream, item)
+
+    def close(self):
+        if self.closed:
+            return
+
+        with atomic_open(self.output_path) as output_file:
+            output_file.write('{')
+            for i, (key, value) in enumerate(self.coco_output.items()):
+                if i > 0:
+                    output_file.write(', ')
+                output_file.write(self.serializer.dumps(key) + ': ')
+
+                if key in self.spools:
+                    spool = self.spools[key]
+                    spool.seek(0)
+                    output_file.write('[')
+                    shutil.copyfileobj(spool, output_file)
+                    output_file.write(']')
+                else:
+                    self.serializer.dump(value, output_file)
+            output_file.write('}')
+
+        if self.columns_writer is not None:
+            self.columns_writer.close()
+
+        self.discard()
+
+    def discard(self):
+        for spool in self.spools.values():
+            spool.close()
+        if self.columns_writer is not None:
+            self.columns_writer.discard()
+        self.closed = True
@@ -0,0 +1,150 @@
+import os
+from pathlib import Path
+
+from coco_json_utils import CocoJsonCreator, create_image_and_annotations
+from coco_json_writer import CocoJsonWriter
+from decoded_images import DecodedImages
+from pycococreator import PyCocoCreator, process_image
+from run_stats import RunStats, profiled
+from worker_pool import map_timed_tasks
+
+
+def process_image_pair(creator_task, json_task, stats=None):
+    """ Runs the PyCocoCreator and the CocoJsonCreator tasks of one image, either may be
+        None, sharing the decoded image and mask files between them
+    Returns:
+        the process_image and the create_image_and_annotations results (None for a missing task)
+    """
+    creator_result = None
+    json_result = None
+
+    with DecodedImages() as decoded_images:
+        if creator_task is not None:
+            creator_result = process_image(*creator_task, stats=stats, decoded_images=decoded_images)
+        if json_task is not None:
+            json_result = create_image_and_annotations(*json_task, stats=stats, decoded_images=decoded_images)
+
+    return creator_result, json_result
+
+
+class CocoPipeline():
+    """ Runs PyCocoCreator and CocoJsonCreator in a single pass over the dataset
+
+        Every image is paired with its CocoJsonCreator mask definition (by image
+        path) and both tasks run together, so each image and mask file is opened
+        and decoded once instead of once per generator. Both output files are
+        written exactly as the two generators would write them on their own.
+    """
+
+    def main(self, args, creator_tools):
+        self.creator = PyCocoCreator()
+        self.json_creator = CocoJsonCreator()
+
+        self.creator.setup(args)
+        self.json_creator.validate_and_process_args(args)
+        self.json_creator.setup(args)
+        self.workers = args.workers
+
+        # one RunStats for the whole pass, shared by both generators
+        self.stats = RunStats('CocoPipeline', progress_interval=args.progress_interval)
+        self.creator.stats = self.stats
+        self.json_creator.stats = self.stats
+
+        with profiled(args.profile_path):
+            self.creator.init_file()
+            image_files_by_root = self.creator.find_image_files()
+
+            # CocoJsonCreator only writes its file with generate_automatic_info, like its main
+            self.json_writer = None
+            json_tasks = []
+            if(args.generate_automatic_info == 1):
+                master_obj, category_ids_by_name = self.json_creator.create_coco_output()
+                json_tasks = self.json_creator.create_tasks(args, category_ids_by_name)
+                self.json_output_path = Path(self.json_creator.dataset_dir) / args.instances_json
+                self.json_writer = CocoJsonWriter(
+                    self.json_output_path, master_obj, streams=['images', 'annotations'],
+                    columns_dir=self.json_output_path.with_suffix('.columns') if args.columnar_output else None,
+                    serializer=self.json_creator.serializer)
+
+            tasks, targets = self.pair_tasks(image_files_by_root, json_tasks, creator_tools)
+            self.process_pairs(tasks, targets)
+
+            self.creator.write_file()
+            if self.json_writer is not None:
+                with self.stats.stage('serialize'):
+                    self.json_writer.close()
+                print(f'CocoJSONUtils - Annotations successfully written to file:\n{self.json_output_path}')
+
+        if args.run_report:
+            self.stats.save(f'{self.creator.base_path}/{self.creator.stage}.pipeline.report.json')
+
+        # both generators share args.cache_dir, one eviction covers them
+        if self.creator.cache is not None:
+            evicted = self.creator.cache.evict()
+            print(f'CocoPipeline - cache: {evicted} entries evicted')
+
+    def pair_tasks(self, image_files_by_root, json_tasks, creator_tools):
+        """ Pairs the PyCocoCreator task of every image with the CocoJsonCreator task of
+            the same image file. Tasks follow the PyCocoCreator order, the mask definitions
+            without an image in it come last.
+        Returns:
+            the (creator_task, json_task) pairs and, for each, the (root_index,
+            image_filename, json_index) needed to write its results
+        """
+        # create_image_and_annotations takes the image path second
+        json_index_by_image = {os.path.abspath(json_task[1]): json_index
+                               for json_index, json_task in enumerate(json_tasks)}
+
+        tasks = []
+        targets = []
+        for root_index, image_files in enumerate(image_files_by_root):
+            creator_tasks = self.creator.create_tasks(image_files, creator_tools)
+            for image_filename, creator_task in zip(image_files, creator_tasks):
+                json_index = json_index_by_image.pop(os.path.abspath(image_filename), None)
+                json_task = json_tasks[json_index] if json_index is not None else None
+
+                tasks.append((creator_task, json_task))
+                targets.append((root_index, image_filename, json_index))
+
+        for json_index in sorted(json_index_by_image.values()):
+            tasks.append((None, json_tasks[json_index]))
+            targets.append((None, None, json_index))
+
+        return tasks, targets
+
+    def process_pairs(self, tasks, targets):
+        # PyCocoCreator results arrive in its own order. CocoJsonCreator results are
+        # held until every earlier mask definition was written, so its ids and file
+        # order match a CocoJsonCreator run even when the two orders differ
+        current_root = None
+        pending_json_results = dict()
+        next_json_index = 0
+
+        results = map_timed_tasks(process_image_pair, tasks, self.workers)
+        for done, ((root_index, image_filename, json_index), (pair_result, stages)) in enumerate(
+                zip(targets, results), start=1):
+            creator_result, json_result = pair_result
+            self.stats.merge(stages)
+
+            if creator_result is not None:
+                # PyCocoCreator numbers segmentations per folder
+                if root_index != current_root:
+                    self.creator.segmentation_id_offset = 0
+                    current_root = root_index
+                image_info, annotations = self.creator.add_result(creator_result)
+                self.creator.write_image(image_filename, image_info, annotations)
+            else:
+                image_info, annotations = json_result[0], json_result[1]
+
+            if json_result is not None:
+                pending_json_results[json_index] = json_result
+                while next_json_index in pending_json_results:
+                    image_obj, annotation_obj = self.json_creator.add_result(
+                        pending_json_results.pop(next_json_index))
+                    with self.stats.stage('serialize'):
+                        self.json_writer.write('images', image_obj)
+                        self.json_writer.write_items('annotations', annotation_obj)
+                    next_json_index += 1
+
+            self.stats.add_image(image_info['width'], image_info['height'], len(annotations))
+            self.stats.progress(done, len(tasks))
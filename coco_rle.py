@@ -0,0 +1,85 @@
+import numpy as np
+
+
+# Every character of a compressed RLE carries 5 bits of a count, the 0x20 bit
+# marks that the count continues in the next character, and the 0x10 bit of
+# the last character is the sign. Characters are offset by 48 to be printable
+CHUNK_BITS = 5
+CONTINUE_BIT = 0x20
+SIGN_BIT = 0x10
+CHAR_OFFSET = 48
+
+
+def compress_rle(rle):
+    """ Converts an uncompressed COCO RLE to the compressed form of pycocotools,
+        whose counts are a string (what mask.encode returns, decoded to str for json)
+    """
+    return {'size': list(rle['size']), 'counts': encode_counts(rle['counts'])}
+
+
+def decompress_rle(rle):
+    """ Converts a compressed COCO RLE back to the uncompressed form, uncompressed ones are returned as they are
+    """
+    if not isinstance(rle['counts'], (str, bytes)):
+        return rle
+    return {'counts': decode_counts(rle['counts']).tolist(), 'size': list(rle['size'])}
+
+
+def encode_counts(counts):
+    """ Encodes RLE counts into a COCO string, like rleToString of the COCO API
+
+        From the fourth count on, each count is stored as the difference to the
+        count two places before it, then as a variable number of 5 bit chunks.
+    """
+    values = np.array(counts, dtype=np.int64)
+    if values.size == 0:
+        return ''
+
+    values[3:] -= np.asarray(counts, dtype=np.int64)[1:-2]
+
+    # chunks[i, k] is the k-th 5 bit chunk of values[i], and a value keeps
+    # emitting chunks while the rest still holds bits other than its sign
+    max_chunks = (64 + CHUNK_BITS - 1) // CHUNK_BITS
+    shifts = np.arange(max_chunks, dtype=np.int64) * CHUNK_BITS
+    chunks = (values[:, None] >> shifts) & 0x1f
+    rests = values[:, None] >> (shifts + CHUNK_BITS)
+    more = np.where(chunks & SIGN_BIT, rests != -1, rests != 0)
+
+    # a chunk is emitted when every chunk before it asked for more
+    emitted = np.ones_like(more)
+    emitted[:, 1:] = np.logical_and.accumulate(more[:, :-1], axis=1)
+
+    chars = chunks + CHAR_OFFSET + np.where(more, CONTINUE_BIT, 0)
+    return chars[emitted].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_counts(string):
+    """ Decodes a COCO RLE string into its counts, like rleFrString of the COCO API
+    """
+    if isinstance(string, str):
+        string = string.encode('ascii')
+
+    chars = np.frombuffer(string, dtype=np.uint8).astype(np.int64) - CHAR_OFFSET
+    if chars.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # each value ends at the first chunk without the continue bit
+    ends = np.flatnonzero((chars & CONTINUE_BIT) == 0)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_index = np.repeat(np.arange(ends.size), ends - starts + 1)
+    chunk_index = np.arange(chars.size) - starts[value_index]
+
+    values = np.zeros(ends.size, dtype=np.int64)
+    np.add.at(values, value_index, (chars & 0x1f) << (chunk_index * CHUNK_BITS))
+
+    # sign extend the values whose last chunk has the sign bit
+    negative = (chars[ends] & SIGN_BIT) != 0
+    lengths = ends - starts + 1
+    values[negative] |= np.left_shift(-1, lengths[negative] * CHUNK_BITS)
+
+    # undo the differences: the odd counts and the even ones from the third on
+    # are running sums of their own sequence
+    counts = values.copy()
+    counts[1::2] = np.cumsum(values[1::2])
+    counts[2::2] = np.cumsum(values[2::2])
+    return counts
@@ -0,0 +1,33 @@
+import os
+
+from PIL import Image
+
+
+class DecodedImages():
+    """ Opens every image file once for all the generators that read it
+
+        open() returns the same PIL image for the same file, so when the
+        PyCocoCreator and CocoJsonCreator generators both read a mask its pixels
+        are decoded by the first load() only. Images are kept until close(), one
+        DecodedImages is meant to live as long as the processing of one image.
+    """
+
+    def __init__(self):
+        self.images = dict()
+
+    def open(self, path):
+        key = os.path.abspath(path)
+        if key not in self.images:
+            self.images[key] = Image.open(path)
+        return self.images[key]
+
+    def close(self):
+        for image in self.images.values():
+            image.close()
+        self.images.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
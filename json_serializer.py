@@ -0,0 +1,82 @@
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional, the json module is used instead
+    orjson = None
+
+
+class JsonSerializer():
+    """ Encodes and decodes the COCO json files
+
+        backend is "json" (the standard library, the default), "orjson" or "auto"
+        (orjson when it is installed). Without orjson installed both fall back to
+        the json module. orjson writes compact json, without the spaces after
+        separators the json module adds, so its files are smaller but not
+        byte-identical to the default ones.
+
+        precision rounds the polygon coordinates, bbox and area of annotations to
+        that many decimals before they are encoded, None keeps the full float repr.
+    """
+
+    BACKENDS = ('json', 'orjson', 'auto')
+
+    def __init__(self, backend='json', precision=None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f'json backend must be one of {self.BACKENDS}, got: {backend}')
+
+        if backend != 'json':
+            if orjson is None:
+                if backend == 'orjson':
+                    print('WARNING: orjson is not installed, using the json module')
+                backend = 'json'
+            else:
+                backend = 'orjson'
+
+        self.backend = backend
+        self.precision = precision
+
+    def dumps(self, obj):
+        if self.backend == 'orjson':
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+        return json.dumps(obj)
+
+    def dump(self, obj, output_file):
+        if self.backend == 'orjson':
+            output_file.write(self.dumps(obj))
+        else:
+            json.dump(obj, output_file)
+
+    def loads(self, data):
+        if self.backend == 'orjson':
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def load(self, input_file):
+        if self.backend == 'orjson':
+            return orjson.loads(input_file.read())
+        return json.load(input_file)
+
+    def round_annotation(self, annotation):
+        """ Returns a copy of the annotation with its polygons, bbox and area rounded to
+            precision decimals, or the annotation itself when precision is None
+        """
+        if self.precision is None:
+            return annotation
+
+        annotation = dict(annotation)
+        if isinstance(annotation.get('area'), (float, np.floating)):
+            annotation['area'] = round(float(annotation['area']), self.precision)
+        if 'bbox' in annotation:
+            annotation['bbox'] = np.round(np.asarray(annotation['bbox'], dtype=np.float64), self.precision).tolist()
+
+        # RLE segmentations are integer counts, only polygons are rounded
+        segmentation = annotation.get('segmentation')
+        if isinstance(segmentation, list):
+            annotation['segmentation'] = [
+                np.round(np.asarray(polygon, dtype=np.float64), self.precision).tolist()
+                for polygon in segmentation]
+
+        return annotation
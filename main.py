@@ -2,6 +2,7 @@ from pycococreator import PyCocoCreator
 from pycococreatortools import PyCocoCreatorTools
 from coco_dataset import CocoDataset
 from coco_json_utils import CocoJsonCreator
+from coco_pipeline import CocoPipeline
 from args import Args
 import os
 
@@ -36,6 +37,45 @@ if __name__ == "__main__":
     parser.add_argument("-rh", "--height", dest="height", default=3000, type=int,
                         help="height to resize images")
 
+    parser.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                        help="number of worker processes, 1 to run serially")
+    parser.add_argument("-cd", "--cache_dir", dest="cache_dir", default=None,
+                        help="directory of the per-mask annotation cache, disabled when empty")
+    parser.add_argument("-cm", "--cache_max_mb", dest="cache_max_mb", default=1024, type=int,
+                        help="cache size in MB, least recently used entries are evicted above it")
+    parser.add_argument("-ck", "--cache_key", dest="cache_key", default="content", choices=["content", "stat"],
+                        help="key masks by their content hash or by their size and mtime")
+    parser.add_argument("-nr", "--native_resolution", dest="native_resolution", default=0, type=int,
+                        help="contour masks at their own resolution and scale the polygons to the image size: 0 or 1")
+    parser.add_argument("-im", "--instance_mode", dest="instance_mode", default="files", choices=["files", "binary", "class"],
+                        help="files: one mask file per instance, binary/class: one mask per image split into connected instances")
+    parser.add_argument("-ix", "--use_index", dest="use_index", default=1, type=int,
+                        help="open the annotations through a sidecar byte-range index: 0 or 1")
+    parser.add_argument("-if", "--image_format", dest="image_format", default="PNG", choices=["PNG", "JPEG", "WEBP"],
+                        help="format of the images embedded in the HTML")
+    parser.add_argument("-iq", "--image_quality", dest="image_quality", default=85, type=int,
+                        help="quality of JPEG/WEBP embedded images")
+    parser.add_argument("-rr", "--run_report", dest="run_report", default=1, type=int,
+                        help="write a json run report with stage timings and throughput next to the outputs: 0 or 1")
+    parser.add_argument("-pi", "--progress_interval", dest="progress_interval", default=5.0, type=float,
+                        help="minimum seconds between progress updates")
+    parser.add_argument("-pp", "--profile_path", dest="profile_path", default=None,
+                        help="run under cProfile and save the stats to this path (main process only)")
+    parser.add_argument("-v", "--verbose", dest="verbose", default=0, type=int,
+                        help="print a line per image/annotation: 0 or 1")
+    parser.add_argument("-up", "--unified_pipeline", dest="unified_pipeline", default=0, type=int,
+                        help="generate both COCO files in a single pass, decoding every image and mask once: 0 or 1")
+    parser.add_argument("-rf", "--rle_format", dest="rle_format", default="uncompressed", choices=["uncompressed", "compressed"],
+                        help="counts of crowd annotations: integer lists or the compact COCO string")
+    parser.add_argument("-co", "--columnar_output", dest="columnar_output", default=0, type=int,
+                        help="also write the annotations as memory-mappable columns next to the json: 0 or 1")
+    parser.add_argument("-uc", "--use_columns", dest="use_columns", default=1, type=int,
+                        help="open the annotations from the columnar files when they exist: 0 or 1")
+    parser.add_argument("-jb", "--json_backend", dest="json_backend", default="json", choices=["json", "orjson", "auto"],
+                        help="json encoder/decoder, orjson is faster and falls back to json when not installed")
+    parser.add_argument("-jp", "--json_precision", dest="json_precision", default=None, type=int,
+                        help="decimals kept in polygon, bbox and area values, full precision when empty")
+
     #args = parser.parse_args()
 
 
@@ -46,8 +86,11 @@ if __name__ == "__main__":
     pycococreatortools = PyCocoCreatorTools()
     cocojsoncreator = CocoJsonCreator()
 
-    pycococreator.main(args, pycococreatortools)
-    cocojsoncreator.main(args)
+    if(args.unified_pipeline):
+        CocoPipeline().main(args, pycococreatortools)
+    else:
+        pycococreator.main(args, pycococreatortools)
+        cocojsoncreator.main(args)
 
     try:
         # just to show and check
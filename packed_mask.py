@@ -0,0 +1,64 @@
+import numpy as np
+from PIL import Image
+
+
+class PackedMask():
+    """ A binary mask stored at one bit per pixel
+
+        Rows are packed most significant bit first and padded to whole bytes, the
+        same layout PIL uses for mode '1' images, so masks move between PIL and
+        PackedMask without unpacking. np.asarray(packed_mask) unpacks it to a bool
+        array, which is only needed where every pixel is visited (encoding, contours).
+
+        A mask may be a crop of a larger frame, offset is the (row, col) of its
+        top-left pixel in that frame.
+    """
+
+    def __init__(self, bits, shape, offset=(0, 0)):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.offset = tuple(offset)
+
+    @classmethod
+    def from_array(cls, array, offset=(0, 0)):
+        array = np.asarray(array, dtype=np.bool_)
+        return cls(np.packbits(array, axis=1), array.shape, offset)
+
+    @classmethod
+    def from_image(cls, image):
+        """ Packs a PIL image, converting it to mode '1' the same way image.convert('1') does
+        """
+        if image.mode != '1':
+            image = image.convert('1')
+
+        width, height = image.size
+        bits = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(height, (width + 7) // 8)
+
+        return cls(bits, (height, width))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def to_image(self):
+        height, width = self.shape
+        return Image.frombytes('1', (width, height), self.bits.tobytes())
+
+    def unpack(self):
+        """ Returns the mask as a (height, width) bool array
+        """
+        height, width = self.shape
+        return np.unpackbits(self.bits, axis=1, count=width).view(np.bool_)
+
+    def resize(self, new_size):
+        """ Resizes like PyCocoCreatorTools.resize_binary_mask does: any pixel the
+            resampled 0/255 image leaves above 0 is part of the mask
+        """
+        image = self.to_image().convert('L').resize(new_size)
+        return PackedMask.from_image(image.point(lambda value: 255 if value > 0 else 0, '1'))
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.unpack()
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
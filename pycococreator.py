@@ -1,15 +1,133 @@
 
 import datetime
-import json
 import os
 import re
 import fnmatch
+from contextlib import nullcontext
 from PIL import Image
-import numpy as np
+from coco_json_writer import CocoJsonWriter
+from annotation_cache import AnnotationCache
+from json_serializer import JsonSerializer
+from packed_mask import PackedMask
+from run_stats import RunStats, profiled, timed
+from worker_pool import map_timed_tasks
+
+
+def process_image(creator_tools, iscrowd, image_id, image_filename, annotation_files, date_captured,
+                  cache=None, native_resolution=False, instance_mode='files', rle_format='uncompressed',
+                  verbose=False, stats=None, decoded_images=None):
+    """ Creates the image info and the annotations of one image and its masks
+    Args:
+        decoded_images: an optional DecodedImages, shared with other generators so every
+            file is opened and decoded only once
+    Returns:
+        image_info, the annotations numbered from 1 and how many segmentation ids they used
+    """
+    creator_tools.stats = stats
+    try:
+        return _process_image(creator_tools, iscrowd, image_id, image_filename, annotation_files,
+                              date_captured, cache, native_resolution, instance_mode, rle_format, verbose,
+                              stats, decoded_images)
+    finally:
+        creator_tools.stats = None
+
+
+def _process_image(creator_tools, iscrowd, image_id, image_filename, annotation_files, date_captured,
+                   cache, native_resolution, instance_mode, rle_format, verbose, stats, decoded_images):
+    if decoded_images is not None:
+        image_size = decoded_images.open(image_filename).size
+    else:
+        with Image.open(image_filename) as image:
+            image_size = image.size
+
+    image_info = creator_tools.create_image_info(
+        image_id, os.path.basename(image_filename), image_size, date_captured=date_captured)
+
+    annotations = []
+    segmentation_id = 1
+
+    if(not annotation_files or len(annotation_files) == 0):
+        print(
+            f'\n-------------------- without annotations_files {image_filename}\n')
+
+    # go through each associated annotation
+    for annotation_filename in annotation_files:
+
+        if verbose:
+            print(f'image_id: {image_id} - {annotation_filename}')
+        #[x['id'] for x in CATEGORIES if x['name'] in annotation_filename][0]
+        class_id = 0
+
+        category_info = {'id': class_id, 'is_crowd': iscrowd}
+        tolerance = 2
+
+        cached = None
+        if cache is not None:
+            with timed(stats, 'cache'):
+                cache_key = cache.key(annotation_filename, {
+                    'category_info': category_info, 'image_size': image_size, 'tolerance': tolerance,
+                    'native_resolution': native_resolution, 'instance_mode': instance_mode,
+                    'rle_format': rle_format})
+                cached = cache.get(cache_key)
+
+        if cached is not None:
+            mask_annotations = cached['annotations']
+        else:
+            if decoded_images is not None:
+                mask_context = nullcontext(decoded_images.open(annotation_filename))
+            else:
+                mask_context = Image.open(annotation_filename)
+
+            with mask_context as mask_image:
+                with timed(stats, 'decode'):
+                    mask_image.load()
+
+                if instance_mode == 'files':
+                    # one instance per mask file
+                    with timed(stats, 'decode'):
+                        binary_mask = PackedMask.from_image(mask_image)
+                    mask_annotations = [creator_tools.create_annotation_info(
+                        segmentation_id, image_id, category_info, binary_mask, image_size, tolerance=tolerance,
+                        native_resolution=native_resolution, compressed_rle=(rle_format == 'compressed'))]
+                else:
+                    # every connected component of the mask file is an instance
+                    mask_annotations = creator_tools.create_instance_annotation_infos(
+                        image_id, category_info, mask_image, image_size, tolerance=tolerance,
+                        class_mask=(instance_mode == 'class'), compressed_rle=(rle_format == 'compressed'))
+
+            if cache is not None:
+                with timed(stats, 'cache'):
+                    cache.put(cache_key, {'annotations': mask_annotations})
+
+        # results are id independent, every instance takes the next segmentation id
+        for annotation_info in mask_annotations:
+            if annotation_info is not None:
+                annotation_info['id'] = segmentation_id
+                annotation_info['image_id'] = image_id
+                annotations.append(annotation_info)
+
+            segmentation_id = segmentation_id + 1
+
+    return image_info, annotations, segmentation_id - 1
+
 
 class PyCocoCreator():
 
     def main(self, args, creator_tools):
+        self.setup(args)
+
+        with profiled(args.profile_path):
+            self.init_file()
+
+            image_files_by_root = self.find_image_files()
+            for image_files in image_files_by_root:
+                self.process_images(image_files, creator_tools)
+
+            self.write_file()
+
+        self.finish(args)
+
+    def setup(self, args):
 
         # print(args)
 
@@ -23,15 +141,46 @@ class PyCocoCreator():
 
         self.stage = args.stage
         self.iscrowd = args.iscrowd
-
-        self.init_file()
-
+        self.workers = args.workers
+        self.native_resolution = args.native_resolution
+        self.instance_mode = args.instance_mode
+        self.rle_format = args.rle_format
+        self.columnar_output = args.columnar_output
+        self.serializer = JsonSerializer(args.json_backend, args.json_precision)
+        self.verbose = args.verbose
+
+        self.stats = RunStats('PyCocoCreator', progress_interval=args.progress_interval)
+
+        self.cache = None
+        if args.cache_dir:
+            self.cache = AnnotationCache(
+                args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024, key_mode=args.cache_key)
+
+    def find_image_files(self):
+        """ Lists the images of every folder under IMAGE_DIR and indexes their masks
+        Returns:
+            a list of image files per folder, image ids are numbered per folder
+        """
         # filter for jpeg images
+        image_files_by_root = []
         for root, _, files in os.walk(self.IMAGE_DIR):
-            image_files = self.filter_for_images(root, files)
-            self.process_images(image_files, creator_tools)
+            image_files_by_root.append(self.filter_for_images(root, files))
 
-        self.write_file()
+        self.build_annotation_index(
+            [image_file for image_files in image_files_by_root for image_file in image_files])
+
+        self.images_done = 0
+        self.images_total = sum(len(image_files) for image_files in image_files_by_root)
+
+        return image_files_by_root
+
+    def finish(self, args):
+        if args.run_report:
+            self.stats.save(f'{self.base_path}/{self.stage}.report.json')
+
+        if self.cache is not None:
+            evicted = self.cache.evict()
+            print(f'PyCocoCreator - cache: {evicted} entries evicted')
 
     def init_file(self):
         self.INFO = {
@@ -67,62 +216,89 @@ class PyCocoCreator():
             "annotations": []
         }
 
-    def process_images(self, image_files, creator_tools):
-        image_id = 1
-        segmentation_id = 1
+        # images and annotations are streamed to the output file as they are created
+        self.writer = CocoJsonWriter(
+            f'{self.base_path}/{self.stage}.json', self.coco_output, streams=["images", "annotations"],
+            columns_dir=f'{self.base_path}/{self.stage}.columns' if self.columnar_output else None,
+            serializer=self.serializer)
+
+    def iter_images_and_annotations(self, args, creator_tools):
+        """ Yields (image_info, annotations) one image at a time, without writing or
+            keeping the dataset, numbered as they are in the json file. Images without
+            annotations are yielded too, with an empty list.
+            Results are computed at most a few images ahead, also with workers, so a
+            data loader can consume them with bounded memory.
+        """
+        self.setup(args)
+
+        for image_files in self.find_image_files():
+            for _, image_info, annotations in self.iter_image_files(image_files, creator_tools):
+                yield image_info, annotations
 
+    def process_images(self, image_files, creator_tools):
         # go through each image
-        for image_filename in image_files:
-            image = Image.open(image_filename)
-            image_info = creator_tools.create_image_info(
-                image_id, os.path.basename(image_filename), image.size)
-            
-            has_annotation = False
-
-            # filter for associated png annotations
-            for root, _, files in os.walk(self.ANNOTATION_DIR):
-                annotation_files = self.filter_for_annotations(
-                    root, files, image_filename)
-
-                if(not annotation_files or len(annotation_files) == 0):
-                    print(
-                        f'\n-------------------- without annotations_files {image_filename}\n')
-
-                # go through each associated annotation
-                for annotation_filename in annotation_files:
-
-                    print(f'image_id: {image_id} - {annotation_filename}')
-                    #[x['id'] for x in CATEGORIES if x['name'] in annotation_filename][0]
-                    class_id = 0
-
-                    category_info = {'id': class_id, 'is_crowd': self.iscrowd}
-                    
-                    binary_mask = np.asarray(Image.open(
-                        annotation_filename).convert('1')).astype(np.uint8)
-
-                    self.annotation_info = creator_tools.create_annotation_info(
-                        segmentation_id, image_id, category_info, binary_mask, image.size, tolerance=2)
-
-                    if self.annotation_info is not None:
-                        self.coco_output["annotations"].append(
-                            self.annotation_info)
-                        has_annotation = True
-
-                    segmentation_id = segmentation_id + 1
-
-            if (has_annotation == True):
-                self.coco_output["images"].append(image_info)
-            else:
-                print(
-                    f'\n------------ The image {image_filename} has no annotations. ------------\n')
-
-            image_id = image_id + 1
+        for image_filename, image_info, annotations in self.iter_image_files(image_files, creator_tools):
+            self.write_image(image_filename, image_info, annotations)
+
+    def iter_image_files(self, image_files, creator_tools):
+        """ Yields (image_filename, image_info, annotations) for the images of one folder
+        """
+        tasks = self.create_tasks(image_files, creator_tools)
+
+        self.segmentation_id_offset = 0
+        results = map_timed_tasks(process_image, tasks, self.workers)
+        for image_filename, (result, stages) in zip(image_files, results):
+            self.stats.merge(stages)
+            image_info, annotations = self.add_result(result)
+
+            self.stats.add_image(image_info['width'], image_info['height'], len(annotations))
+            self.images_done += 1
+            self.stats.progress(self.images_done, self.images_total)
+
+            yield image_filename, image_info, annotations
+
+    def create_tasks(self, image_files, creator_tools):
+        # Image ids are counters over the input order, so they are assigned up
+        # front and every image can be processed independently
+        date_captured = datetime.datetime.utcnow().isoformat(' ')
+        tasks = []
+
+        for image_id, image_filename in enumerate(image_files, start=1):
+            # associated png annotations, looked up in the prebuilt index
+            annotation_files = self.annotation_index.get(
+                self.get_stem(image_filename), [])
+
+            tasks.append((creator_tools, self.iscrowd, image_id, image_filename,
+                          annotation_files, date_captured, self.cache,
+                          self.native_resolution, self.instance_mode, self.rle_format, self.verbose))
+
+        return tasks
+
+    def add_result(self, result):
+        # Each image numbers its segmentations from 1, they are shifted here as
+        # results come back in input order, matching a serial run
+        image_info, annotations, segmentation_count = result
+
+        for annotation_info in annotations:
+            annotation_info['id'] += self.segmentation_id_offset
+        self.segmentation_id_offset += segmentation_count
+
+        return image_info, annotations
+
+    def write_image(self, image_filename, image_info, annotations):
+        if (len(annotations) > 0):
+            with self.stats.stage('serialize'):
+                self.writer.write("images", image_info)
+                self.writer.write_items("annotations", annotations)
+        else:
+            print(
+                f'\n------------ The image {image_filename} has no annotations. ------------\n')
 
     def write_file(self):
-        with open(f'{self.base_path}/{self.stage}.json', 'w+') as output_json_file:
-            json.dump(self.coco_output, output_json_file)
-            
-            print(f"\n\nPyCocoCreator - file saved {self.base_path}{self.stage}.json\n")
+        with self.stats.stage('serialize'):
+            self.writer.close()
+
+        print(f"\n\nPyCocoCreator - file saved {self.base_path}{self.stage}.json\n")
 
     def filter_for_images(self, root, files):
         file_types = ['*.jpeg', '*.jpg', '*.JPEG', '*.JPG', '*.png', '*.PNG']
@@ -136,18 +312,54 @@ class PyCocoCreator():
 
         return files
 
-    def filter_for_annotations(self, root, files, image_filename):
-        file_types = ['*.jpeg', '*.jpg', '*.JPEG', '*.JPG', '*.png', '*.PNG']
-        file_types = r'|'.join([fnmatch.translate(x) for x in file_types])
-        basename_no_extension = os.path.splitext(
-            os.path.basename(image_filename))[0]
-        file_name_prefix = basename_no_extension + '.*'
-        files = [os.path.join(root, f) for f in files]
-        files = [f for f in files if re.match(file_types, f)]
-        files = [f for f in files if re.match(
-            file_name_prefix, os.path.splitext(os.path.basename(f))[0])]
+    def build_annotation_index(self, image_files):
+        # Maps every image stem to its mask files with a single scan of ANNOTATION_DIR.
+        # A mask belongs to an image when its stem is the image stem itself or the
+        # image stem followed by the "_" delimiter, so 1001_circle_0.png pairs with
+        # 1001.jpeg but never with 100.jpeg
+        image_stems = {self.get_stem(f) for f in image_files}
 
-        return files
+        self.annotation_index = {stem: [] for stem in image_stems}
+        self.orphan_masks = []
+
+        for root, _, files in os.walk(self.ANNOTATION_DIR):
+            for annotation_filename in self.filter_for_images(root, files):
+                stem = self.match_image_stem(
+                    self.get_stem(annotation_filename), image_stems)
+
+                if stem is None:
+                    self.orphan_masks.append(annotation_filename)
+                else:
+                    self.annotation_index[stem].append(annotation_filename)
+
+        for annotation_files in self.annotation_index.values():
+            annotation_files.sort(
+                key=lambda f: self.natrual_key(os.path.basename(f)))
+
+        self.unmatched_images = sorted(
+            stem for stem, annotation_files in self.annotation_index.items() if not annotation_files)
+
+        print(f'Annotation index: {len(image_stems)} images - '
+              f'{len(self.orphan_masks)} orphan masks - '
+              f'{len(self.unmatched_images)} images without masks')
+
+        return self.annotation_index
+
+    def match_image_stem(self, mask_stem, image_stems):
+        if mask_stem in image_stems:
+            return mask_stem
+
+        # try the longest prefix first, image stems may contain the delimiter too
+        delimiter = mask_stem.rfind('_')
+        while delimiter > 0:
+            if mask_stem[:delimiter] in image_stems:
+                return mask_stem[:delimiter]
+            delimiter = mask_stem.rfind('_', 0, delimiter)
+
+        return None
+
+    def get_stem(self, filename):
+        return os.path.splitext(os.path.basename(filename))[0]
 
     def convert(self, text):
         return int(text) if text.isdigit() else text.lower()
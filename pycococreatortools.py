@@ -4,14 +4,18 @@ import os
 import re
 import datetime
 import numpy as np
-from itertools import groupby
 from skimage import measure
 from PIL import Image
-from pycocotools import mask
+from coco_rle import compress_rle
+from packed_mask import PackedMask
+from run_stats import timed
  
 
 class PyCocoCreatorTools():
 
+    # an optional RunStats, the resize/encode/contour stages are timed into it
+    stats = None
+
     def convert(self, text):
         return int(text) if text.isdigit() else text.lower()
 
@@ -19,6 +23,9 @@ class PyCocoCreatorTools():
         return [self.convert(c) for c in re.split('([0-9]+)', key)]
 
     def resize_binary_mask(self, array, new_size):
+        if isinstance(array, PackedMask):
+            return array.resize(new_size)
+
         image = Image.fromarray(array.astype(np.uint8)*255)
         image = image.resize(new_size)
         return np.asarray(image).astype(np.bool_)
@@ -29,31 +36,90 @@ class PyCocoCreatorTools():
         return contour
 
     def binary_mask_to_rle(self, binary_mask):
+        """Converts a binary mask to uncompressed COCO RLE (column-major counts)
+
+        Runs are found from the positions where consecutive pixels differ, so
+        the mask is never iterated pixel by pixel in Python.
+        """
+        return self.mask_statistics(binary_mask)[0]
+
+    def mask_statistics(self, binary_mask):
+        """Computes the uncompressed COCO RLE, area and bbox of a binary mask in a single pass
+
+        Area and bbox are derived from the runs, so they match pycocotools'
+        mask.area and mask.toBbox without encoding the mask a second time.
+
+        Returns:
+            (rle, area, bbox) with area as a numpy integer and bbox as a float array [x, y, w, h]
+        """
+        height = binary_mask.shape[0]
         rle = {'counts': [], 'size': list(binary_mask.shape)}
-        counts = rle.get('counts')
-        for i, (value, elements) in enumerate(groupby(binary_mask.ravel(order='F'))):
-            if i == 0 and value == 1:
-                counts.append(0)
-            counts.append(len(list(elements)))
+        pixels = np.asarray(binary_mask).ravel(order='F')
+        if pixels.dtype != np.bool_:
+            pixels = pixels != 0
+        if pixels.size == 0:
+            return rle, np.int64(0), np.zeros(4)
 
-        return rle
+        # a run starts at 0 and wherever a pixel differs from the previous one
+        run_starts = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+        run_edges = np.concatenate(([0], run_starts, [pixels.size]))
+        counts = np.diff(run_edges)
 
-    def binary_mask_to_polygon(self, binary_mask, tolerance=0):
+        # COCO counts always start with a run of zeros
+        first_foreground = 1
+        if pixels[0]:
+            first_foreground = 0
+            rle['counts'].append(0)
+        rle['counts'] += counts.tolist()
+
+        # runs alternate, the foreground ones are every other run
+        foreground_starts = run_edges[first_foreground:-1:2]
+        foreground_ends = run_edges[first_foreground + 1::2] - 1
+        area = np.int64(counts[first_foreground::2].sum())
+        if area == 0:
+            return rle, area, np.zeros(4)
+
+        start_cols, start_rows = np.divmod(foreground_starts, height)
+        end_cols, end_rows = np.divmod(foreground_ends, height)
+
+        # a run that wraps into the next column covers the full height
+        if np.any(end_cols > start_cols):
+            y_min, y_max = 0, height - 1
+        else:
+            y_min, y_max = start_rows.min(), end_rows.max()
+        x_min, x_max = start_cols.min(), end_cols.max()
+
+        bbox = np.array([x_min, y_min, x_max - x_min + 1, y_max - y_min + 1], dtype=np.float64)
+
+        return rle, area, bbox
+
+    def binary_mask_to_polygon(self, binary_mask, tolerance=0, offset=(0, 0)):
         """Converts a binary mask to COCO polygon representation
 
         Args:
             binary_mask: a 2D binary numpy array where '1's represent the object
             tolerance: Maximum distance from original points of polygon to approximated
                 polygonal chain. If tolerance is 0, the original coordinate array is returned.
+            offset: (row, col) of the mask's top-left pixel, when it is a crop of a larger frame
 
         """
         polygons = []
+        binary_mask = np.asarray(binary_mask)
+
+        # contour only the tight bounding region of the object, not the whole frame
+        rows = np.flatnonzero(binary_mask.any(axis=1))
+        if rows.size == 0:
+            return polygons
+        cols = np.flatnonzero(binary_mask.any(axis=0))
+        cropped_binary_mask = binary_mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
         # pad mask to close contours of shapes which start and end at an edge
         padded_binary_mask = np.pad(
-            binary_mask, pad_width=1, mode='constant', constant_values=0)
+            cropped_binary_mask, pad_width=1, mode='constant', constant_values=0)
         contours = measure.find_contours(padded_binary_mask, 0.5)
-        contours = np.subtract(contours, 1)
         for contour in contours:
+            # remove the padding and move the crop back to its place in the frame
+            contour = np.add(contour, (rows[0] - 1 + offset[0], cols[0] - 1 + offset[1]))
             contour = self.close_contour(contour)
             contour = measure.approximate_polygon(contour, tolerance)
             if len(contour) < 3:
@@ -83,31 +149,82 @@ class PyCocoCreatorTools():
 
         return image_info
 
+    def get_mask_scale(self, binary_mask, image_size):
+        """Returns the (x, y) factors that map mask coordinates to image_size coordinates"""
+        return image_size[0] / binary_mask.shape[1], image_size[1] / binary_mask.shape[0]
+
+    def scale_polygons(self, polygons, scale):
+        # contour points are measured from pixel centres, so the centre of mask
+        # pixel c lands on the centre of image pixels c * s .. (c + 1) * s - 1
+        scaled_polygons = []
+        for polygon in polygons:
+            points = (np.asarray(polygon, dtype=np.float64).reshape(-1, 2) + 0.5) * scale - 0.5
+            scaled_polygons.append(points.ravel().tolist())
+
+        return scaled_polygons
+
     def create_annotation_info(self, annotation_id, image_id, category_info, binary_mask,
-                               image_size=None, tolerance=2, bounding_box=None):
+                               image_size=None, tolerance=2, bounding_box=None, native_resolution=False,
+                               compressed_rle=False):
+        """Creates a COCO annotation from a binary mask
+
+        Args:
+            binary_mask: a 2D binary numpy array or a PackedMask
+            image_size: (width, height) of the image, the mask is resized to it when it differs
+            native_resolution: extract polygons, area and bbox from the mask as it is and scale
+                them to image_size analytically, instead of resizing the mask first. Crowd
+                annotations need their RLE at image size, so they are always resized.
+            compressed_rle: write crowd annotations with the compressed (string) COCO RLE counts
 
+        """
+        scale = None
         if image_size is not None:
-            binary_mask = self.resize_binary_mask(binary_mask, image_size)
+            if native_resolution and category_info["is_crowd"] != 1:
+                scale = self.get_mask_scale(binary_mask, image_size)
+                if scale == (1.0, 1.0):
+                    scale = None
+            else:
+                with timed(self.stats, 'resize'):
+                    binary_mask = self.resize_binary_mask(binary_mask, image_size)
 
-        binary_mask_encoded = mask.encode(
-            np.asfortranarray(binary_mask.astype(np.uint8)))
+        with timed(self.stats, 'encode'):
+            # bit-packed masks are only unpacked here, where every pixel is visited
+            if isinstance(binary_mask, PackedMask):
+                binary_mask = binary_mask.unpack()
 
-        area = mask.area(binary_mask_encoded)
+            rle, area, mask_bounding_box = self.mask_statistics(binary_mask)
         if area < 1:
             return None
 
         if bounding_box is None:
-            bounding_box = mask.toBbox(binary_mask_encoded)
+            bounding_box = mask_bounding_box
+            if scale is not None:
+                bounding_box = bounding_box * np.tile(scale, 2)
 
         if category_info["is_crowd"] == 1:
             is_crowd = 1
-            segmentation = self.binary_mask_to_rle(binary_mask)
+            segmentation = rle
+            if compressed_rle:
+                with timed(self.stats, 'encode'):
+                    segmentation = compress_rle(rle)
         else:
             is_crowd = 0
-            segmentation = self.binary_mask_to_polygon(binary_mask, tolerance)
+            with timed(self.stats, 'contour'):
+                if scale is None:
+                    segmentation = self.binary_mask_to_polygon(binary_mask, tolerance)
+                else:
+                    # keep the simplification tolerance in image pixels
+                    segmentation = self.binary_mask_to_polygon(binary_mask, tolerance / max(scale))
+                    segmentation = self.scale_polygons(segmentation, scale)
             if not segmentation:
                 return None
 
+        if scale is not None:
+            area = area * scale[0] * scale[1]
+            width, height = image_size
+        else:
+            width, height = binary_mask.shape[1], binary_mask.shape[0]
+
         # Detectron2 - bbox_mode
         # https://detectron2.readthedocs.io/en/latest/modules/structures.html#detectron2.structures.BoxMode
         # detectron2.structures.BoxMode
@@ -126,8 +243,141 @@ class PyCocoCreatorTools():
             "bbox": bounding_box.tolist(),
             "bbox_mode": 0, # 0
             "segmentation": segmentation,
-            "width": binary_mask.shape[1],
-            "height": binary_mask.shape[0],
+            "width": width,
+            "height": height,
+        }
+
+        return annotation_info
+
+    def cropped_mask_to_rle(self, binary_mask, offset, frame_shape):
+        """Converts a mask cropped out of a frame to the uncompressed COCO RLE of the whole frame
+
+        Only the crop's pixels are visited, the runs of background around it are
+        computed from the offset and the frame shape.
+        """
+        crop_height = binary_mask.shape[0]
+        frame_height, frame_width = frame_shape
+
+        # column-major positions of the object pixels in the whole frame, in increasing order
+        positions = np.flatnonzero(np.asarray(binary_mask).ravel(order='F'))
+        cols, rows = np.divmod(positions, crop_height)
+        positions = (cols + offset[1]) * frame_height + rows + offset[0]
+
+        rle = {'counts': [], 'size': [frame_height, frame_width]}
+        if positions.size == 0:
+            rle['counts'] = [frame_height * frame_width]
+            return rle
+
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        run_starts = positions[np.concatenate(([0], breaks))]
+        run_ends = positions[np.concatenate((breaks - 1, [-1]))] + 1
+
+        counts = np.empty(2 * run_starts.size, dtype=np.int64)
+        counts[0] = run_starts[0]
+        counts[1::2] = run_ends - run_starts
+        counts[2::2] = run_starts[1:] - run_ends[:-1]
+        counts = counts.tolist()
+
+        trailing = frame_height * frame_width - int(run_ends[-1])
+        if trailing > 0:
+            counts.append(trailing)
+
+        rle['counts'] = counts
+        return rle
+
+    def split_instances(self, labels):
+        """Splits a binary or class mask into its connected instances with a single labeling pass
+
+        Args:
+            labels: a 2D numpy array, 0 is background and every other value a class
+
+        Yields:
+            (class_value, instance_mask, offset, area) per instance, where instance_mask is the
+            instance cropped to its bounding box and offset the (row, col) of that box
+        """
+        instance_labels = measure.label(labels, background=0)
+        for region in measure.regionprops(instance_labels):
+            min_row, min_col, max_row, max_col = region.bbox
+            instance_mask = region.image
+            class_value = labels[min_row:max_row, min_col:max_col][instance_mask][0]
+
+            yield class_value.item(), instance_mask, (min_row, min_col), int(instance_mask.sum())
+
+    def create_instance_annotation_infos(self, image_id, category_info, mask_image, image_size=None,
+                                         tolerance=2, class_mask=False, compressed_rle=False):
+        """Creates the annotations of every connected instance in a single mask image
+
+        Args:
+            mask_image: a PIL image, binary (converted to mode '1') or, with
+                class_mask, a class mask whose pixel values are the category ids
+            image_size: (width, height) of the image, the mask is resized to it when it differs
+            compressed_rle: write crowd annotations with the compressed (string) COCO RLE counts
+
+        Returns:
+            a list with one annotation (or None, when it has no usable polygon) per instance,
+            numbered from 1
+        """
+        with timed(self.stats, 'resize'):
+            if class_mask:
+                if image_size is not None and mask_image.size != tuple(image_size):
+                    # class values must survive resizing, so no interpolation
+                    mask_image = mask_image.resize(tuple(image_size), Image.NEAREST)
+                labels = np.asarray(mask_image if mask_image.mode in ('L', 'P') else mask_image.convert('L'))
+            else:
+                binary_mask = PackedMask.from_image(mask_image)
+                if image_size is not None:
+                    binary_mask = self.resize_binary_mask(binary_mask, image_size)
+                labels = binary_mask.unpack()
+
+        with timed(self.stats, 'isolate'):
+            instances = list(self.split_instances(labels))
+
+        annotation_infos = []
+        for annotation_id, (class_value, instance_mask, offset, area) in enumerate(instances, start=1):
+            instance_category_info = category_info
+            if class_mask:
+                instance_category_info = dict(category_info, id=class_value)
+
+            annotation_infos.append(self.create_instance_annotation_info(
+                annotation_id, image_id, instance_category_info, instance_mask, offset,
+                labels.shape, area, tolerance, compressed_rle))
+
+        return annotation_infos
+
+    def create_instance_annotation_info(self, annotation_id, image_id, category_info, instance_mask,
+                                        offset, frame_shape, area, tolerance=2, compressed_rle=False):
+        """Creates a COCO annotation for an instance cropped to its bounding box
+
+        Area and bbox come from the labeling pass, and the instance is encoded within
+        its own region only.
+        """
+        crop_height, crop_width = instance_mask.shape
+        bounding_box = [float(offset[1]), float(offset[0]), float(crop_width), float(crop_height)]
+
+        if category_info["is_crowd"] == 1:
+            is_crowd = 1
+            with timed(self.stats, 'encode'):
+                segmentation = self.cropped_mask_to_rle(instance_mask, offset, frame_shape)
+                if compressed_rle:
+                    segmentation = compress_rle(segmentation)
+        else:
+            is_crowd = 0
+            with timed(self.stats, 'contour'):
+                segmentation = self.binary_mask_to_polygon(instance_mask, tolerance, offset=offset)
+            if not segmentation:
+                return None
+
+        annotation_info = {
+            "id": annotation_id,
+            "image_id": image_id,
+            "category_id": category_info["id"],
+            "iscrowd": is_crowd,
+            "area": area,
+            "bbox": bounding_box,
+            "bbox_mode": 0,
+            "segmentation": segmentation,
+            "width": frame_shape[1],
+            "height": frame_shape[0],
         }
 
         return annotation_info
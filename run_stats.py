@@ -0,0 +1,147 @@
+import cProfile
+import datetime
+import json
+import platform
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+from atomic_write import atomic_open
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+class RunStats():
+    """ Collects per-stage timings and throughput of a generation run
+
+        Stages are timed with the stage() context manager and accumulate their
+        seconds and call counts. Worker processes time into their own RunStats
+        and send stages back as a plain dict, which merge() adds to the parent's.
+        report() summarizes the run (images/sec, pixels/sec, peak memory) as a
+        json-ready dict and save() writes it next to the generated file.
+    """
+
+    def __init__(self, name='run', progress_interval=5.0):
+        self.name = name
+        self.progress_interval = progress_interval
+
+        self.stages = dict()
+        self.images = 0
+        self.pixels = 0
+        self.annotations = 0
+
+        self.start_time = time.perf_counter()
+        self.last_progress = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds, calls=1):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += calls
+
+    def merge(self, stages):
+        """ Adds the stages of another RunStats, e.g. one that ran in a worker process
+        """
+        for name, stage in stages.items():
+            self.add_stage(name, stage['seconds'], stage['calls'])
+
+    def add_image(self, width, height, annotations=0):
+        self.images += 1
+        self.pixels += width * height
+        self.annotations += annotations
+
+    def progress(self, done, total):
+        """ Prints the progress at most once every progress_interval seconds, and at the end
+        """
+        now = time.perf_counter()
+        if done < total and self.last_progress is not None and now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+
+        elapsed = now - self.start_time
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print(f'{self.name}: {done}/{total} images - {rate:.2f} images/s - {elapsed:.1f}s')
+
+    def peak_memory_mb(self):
+        """ Peak resident memory of this process and of its finished worker processes
+        """
+        if resource is None:
+            return None
+
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        unit = 1 if sys.platform == 'darwin' else 1024
+        peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+        peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+
+        return {
+            'process': peak_self / (1024 * 1024),
+            'workers': peak_children / (1024 * 1024),
+        }
+
+    def report(self):
+        wall_seconds = time.perf_counter() - self.start_time
+
+        return {
+            'name': self.name,
+            'created': datetime.datetime.now().isoformat(' '),
+            'python': platform.python_version(),
+            'wall_seconds': wall_seconds,
+            'images': self.images,
+            'annotations': self.annotations,
+            'pixels': self.pixels,
+            'images_per_second': self.images / wall_seconds if wall_seconds > 0 else None,
+            'pixels_per_second': self.pixels / wall_seconds if wall_seconds > 0 else None,
+            'peak_memory_mb': self.peak_memory_mb(),
+            # with workers, stage seconds are summed over all processes and may exceed wall_seconds
+            'stages': self.stages,
+        }
+
+    def save(self, report_path):
+        report = self.report()
+
+        with atomic_open(report_path) as report_file:
+            json.dump(report, report_file, indent=4)
+
+        print(f'{self.name} - run report saved at: {report_path}')
+        print(f'{self.name} - {report["images"]} images in {report["wall_seconds"]:.2f}s - '
+              f'{report["images_per_second"] or 0:.2f} images/s - '
+              f'{(report["pixels_per_second"] or 0) / 1e6:.2f} Mpixels/s')
+
+        return report
+
+
+def timed(stats, name):
+    """ stats.stage(name), or a no-op when stats is None
+    """
+    if stats is None:
+        return nullcontext()
+    return stats.stage(name)
+
+
+@contextmanager
+def profiled(profile_path):
+    """ Runs the block under cProfile and dumps the stats to profile_path, a no-op when
+        profile_path is empty. Only the calling process is profiled, not its workers.
+    """
+    if not profile_path:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        print(f'Profile saved at: {profile_path} - view it with: python -m pstats {profile_path}')
@@ -0,0 +1,42 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from run_stats import RunStats
+
+
+def map_tasks(function, tasks, workers):
+    """ Runs function over tasks, in a process pool when more than one worker
+        was requested, always yielding the results in the order of tasks.
+        At most 4 tasks per worker are in flight, so a slow consumer of the
+        results holds a bounded number of them in memory
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        yield from map(function, tasks)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for task in tasks:
+            pending.append(executor.submit(function, task))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_timed(function, task):
+    """ Calls function(*task) with a RunStats of its own. The function and this
+        wrapper are module level, so they can run in the worker processes.
+    Returns:
+        the result of function and the timed stages, to be merged by the parent
+    """
+    stats = RunStats()
+    return function(*task, stats=stats), stats.stages
+
+
+def map_timed_tasks(function, tasks, workers):
+    """ map_tasks for the functions that take a stats keyword, yields (result, stages)
+    """
+    return map_tasks(partial(run_timed, function), tasks, workers)